@@ -1,172 +1,1720 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import hmac
 import hashlib
+import base64
+import csv
+import io
+import html
 import psycopg2
-from flask import Flask, request
-import traceback
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+from flask import Flask, request, send_file
+import logging
+import logging.handlers
+import random
 import time
+import threading
+import queue
+import select
+import atexit
+import signal
+import sys
+import bisect
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 TOKEN = os.getenv("BOT_TOKEN")
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-RENDER_URL = "https://bpharmabot-rp6m.onrender.com"
+# Public base URL for the Telegram/Razorpay webhooks and the payment page
+RENDER_URL = os.getenv("RENDER_URL", "https://bpharmabot-rp6m.onrender.com")
+# Overridable so the bot can run against local stand-ins (see benchmark.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+RAZORPAY_API_URL = os.getenv("RAZORPAY_API_URL", "https://api.razorpay.com")
 
 WEBHOOK_PATH = "/webhook"
 PAYMENT_WEBHOOK_PATH = "/payment_webhook"
 PAYMENT_SUCCESS_PATH = "/payment_success"
+DOWNLOAD_PATH = "/download"
 WEBHOOK_URL = RENDER_URL + WEBHOOK_PATH
 PAYMENT_WEBHOOK_URL = RENDER_URL + PAYMENT_WEBHOOK_PATH
 PAPER_FOLDER = "bpharm_bot_18"
+# Smaller copies written by optimize_pdfs.py, preferred over PAPER_FOLDER when present
+OPTIMIZED_FOLDER = os.getenv("OPTIMIZED_FOLDER", PAPER_FOLDER + "_optimized")
+
+# "webhook" receives updates from Telegram; "polling" pulls them with getUpdates
+RUN_MODE = os.getenv("RUN_MODE", "webhook")
+# "sync" runs handlers inside the request; "async" queues them for workers
+WEBHOOK_DISPATCH = os.getenv("WEBHOOK_DISPATCH", "sync")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "200"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+# "media_group" sends both PDFs in one album; "single" sends one by one;
+# "link" sends signed download buttons served by DOWNLOAD_PATH instead of uploading
+DOCUMENT_DELIVERY = os.getenv("DOCUMENT_DELIVERY", "media_group")
+UPDATE_DEDUP_WINDOW = float(os.getenv("UPDATE_DEDUP_WINDOW", "3600"))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "100000"))
+UPDATE_DEDUP_DB = os.getenv("UPDATE_DEDUP_DB", "0") == "1"
 
 app = Flask(__name__)
 
 # -------------------------
-# Simple Database Functions (No Pool)
+# Metrics
 # -------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Counter:
+    """Monotonic counter with labels, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Latency histogram with labels, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        for labels, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names + ("le",), labels + (str(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = _format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {values[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape_label(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+handler_seconds = Histogram("bot_handler_seconds", "Time spent in update handlers", ("handler",))
+telegram_seconds = Histogram("bot_telegram_request_seconds", "Telegram Bot API call latency", ("method",))
+razorpay_seconds = Histogram("bot_razorpay_request_seconds", "Razorpay API call latency", ("operation",))
+db_seconds = Histogram("bot_db_seconds", "Time spent in database helpers", ("helper",))
+db_transactions_total = Counter("bot_db_transactions_total", "Database round trips (pooled transactions)")
+errors_total = Counter("bot_errors_total", "Errors by component and operation", ("component", "operation"))
+document_bytes_total = Counter("bot_document_bytes_uploaded_total", "PDF bytes uploaded to Telegram")
+download_requests_total = Counter("bot_download_requests_total", "Signed download link requests", ("result",))
+log_records_dropped_total = Counter("bot_log_records_dropped_total", "Log records not written", ("reason",))
+edits_skipped_total = Counter(
+    "bot_telegram_edits_skipped_total", "editMessageText calls skipped because the message already showed that screen"
+)
+
+METRICS = [
+    handler_seconds, telegram_seconds, razorpay_seconds, db_seconds,
+    db_transactions_total, errors_total, document_bytes_total, log_records_dropped_total,
+    download_requests_total, edits_skipped_total,
+]
+
+def timed(histogram, component):
+    """Decorator recording the function's latency and raised errors"""
+    def decorator(fn):
+        label = (fn.__qualname__,)
+        
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                if component == "handler":
+                    with log_context(handler=fn.__qualname__):
+                        return fn(*args, **kwargs)
+                return fn(*args, **kwargs)
+            except Exception:
+                errors_total.inc((component, fn.__qualname__))
+                raise
+            finally:
+                histogram.observe(label, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+# -------------------------
+# Logging
+# -------------------------
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Per-logger overrides, e.g. "bot.payments=WARNING" silences payment-check chatter
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Fraction of high-volume info lines (webhook receipts, callbacks) that get written
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+# Pass as extra= to mark a record as subject to LOG_SAMPLE_RATE
+SAMPLED = {"sampled": True}
+
+_log_context = threading.local()
+
+def get_log_context():
+    return getattr(_log_context, "fields", {})
+
+@contextmanager
+def log_context(**fields):
+    """Attach fields such as update_id, user_id and handler to this thread's log records"""
+    previous = get_log_context()
+    _log_context.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _log_context.fields = previous
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """Queues records for a per-process writer thread.
+
+    Callers only snapshot their log context and enqueue; formatting and the
+    stdout write happen on the writer thread. When the queue is full the
+    record is dropped and counted rather than blocking a request.
+    """
+
+    def __init__(self, queue_size, sample_rate):
+        super().__init__(queue.Queue(maxsize=queue_size))
+        self.sample_rate = sample_rate
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # Forked: the parent's writer thread did not come along
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(JsonFormatter())
+            self._listener = logging.handlers.QueueListener(self.queue, stream)
+            self._listener.start()
+            self._pid = pid
+
+    def emit(self, record):
+        if getattr(record, "sampled", False) and random.random() >= self.sample_rate:
+            log_records_dropped_total.inc(("sampled",))
+            return
+        super().emit(record)
+
+    def prepare(self, record):
+        record.context = get_log_context()
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped_total.inc(("queue_full",))
+
+    def stop(self):
+        """Write out everything queued; called at exit"""
+        with self._lock:
+            if self._listener is None or self._pid != os.getpid():
+                return
+            try:
+                self._listener.stop()
+            except queue.Full:
+                pass
+            self._listener = None
+            self._pid = None
+
+    def get_stats(self):
+        return {
+            "level": LOG_LEVEL,
+            "sample_rate": self.sample_rate,
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+        }
+
+def configure_logging():
+    handler = BackgroundLogHandler(LOG_QUEUE_SIZE, LOG_SAMPLE_RATE)
+    root = logging.getLogger("bot")
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(handler)
+    root.propagate = False
+    for override in LOG_LEVELS.split(","):
+        if "=" in override:
+            name, level = override.split("=", 1)
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+    atexit.register(handler.stop)
+    return handler
+
+log_handler = configure_logging()
+log = logging.getLogger("bot")
+update_log = logging.getLogger("bot.updates")
+payment_log = logging.getLogger("bot.payments")
+
+# -------------------------
+# Database Connection Pool
+# -------------------------
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", "30"))
+
+# Session writes are buffered and upserted in batches unless disabled. Other
+# workers only see a write once it is flushed, so the interval is kept short;
+# set SESSION_WRITE_BEHIND=0 if workers must never read a stale session
+SESSION_WRITE_BEHIND = os.getenv("SESSION_WRITE_BEHIND", "1") == "1"
+SESSION_FLUSH_INTERVAL_MS = int(os.getenv("SESSION_FLUSH_INTERVAL_MS", "50"))
+SESSION_FLUSH_MAX = int(os.getenv("SESSION_FLUSH_MAX", "200"))
+EVENT_LOG = os.getenv("EVENT_LOG", "1") == "1"
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", "10000"))
+EVENT_FLUSH_INTERVAL_MS = int(os.getenv("EVENT_FLUSH_INTERVAL_MS", "2000"))
+EVENT_FLUSH_MAX = int(os.getenv("EVENT_FLUSH_MAX", "1000"))
+
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "1") == "1"
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "bot_cache_invalidation")
+
+_db_pool = None
+_db_pool_pid = None
+_db_pool_slots = None
+_db_pool_lock = threading.Lock()
+# Last time a connection broke mid-use; older idle connections get checked
+_db_pool_failed_at = 0.0
+_db_stats_lock = threading.Lock()
+_db_pool_stats = {
+    "checkouts": 0,
+    "checkins": 0,
+    "in_use": 0,
+    "healthchecks": 0,
+    "reconnects": 0,
+    "waits": 0,
+    "timeouts": 0,
+    "errors": 0,
+}
+
+def _db_stat(key, delta=1):
+    with _db_stats_lock:
+        _db_pool_stats[key] += delta
+
+class PooledConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers when it was last returned to the pool.
+
+    The base connection type takes no extra attributes, hence the subclass.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_used = time.monotonic()
+
+def _get_db_pool():
+    """Get the connection pool for this worker process.
+
+    The pool is created lazily and re-created after a fork so each gunicorn
+    worker owns its own bounded set of connections.
+    """
+    global _db_pool, _db_pool_pid, _db_pool_slots
+    pid = os.getpid()
+    if _db_pool is not None and _db_pool_pid == pid:
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != pid:
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, connect_timeout=10,
+                connection_factory=PooledConnection,
+            )
+            # minconn only sets how many connections open up front; psycopg2
+            # also closes any connection checked in above it, so raise it to
+            # keep connections opened during a burst for reuse
+            _db_pool.minconn = DB_POOL_MAX
+            # psycopg2 pools raise instead of blocking when exhausted, so
+            # callers wait on a semaphore sized to the pool first
+            _db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _db_pool_pid = pid
+            _db_pool_stats["in_use"] = 0
+            log.info("🏊 DB pool ready (pid=%s, min=%s, max=%s)", pid, DB_POOL_MIN, DB_POOL_MAX)
+    return _db_pool
+
+def _db_connection_alive(conn):
+    """Cheap liveness check for a pooled connection"""
+    if conn.closed:
+        return False
+    # An idle connection has nothing to read unless the server hung up or
+    # sent a shutdown notice, so this catches restarts without a round trip
+    readable, _, _ = select.select([conn], [], [], 0)
+    recent = time.monotonic() - conn.last_used < DB_POOL_HEALTHCHECK_IDLE
+    if not readable and recent and conn.last_used > _db_pool_failed_at:
+        return True
+    _db_stat("healthchecks")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
 def get_db_connection():
-    """Get a fresh database connection"""
+    """Check out a healthy connection from the pool"""
+    if not DATABASE_URL:
+        return None
     try:
-        return psycopg2.connect(DATABASE_URL, connect_timeout=10)
+        pool = _get_db_pool()
     except Exception as e:
-        print(f"❌ Database connection error: {e}")
+        _db_stat("errors")
+        log.error("❌ Database connection error: %s", e)
         return None
 
+    slots = _db_pool_slots
+    if not slots.acquire(blocking=False):
+        _db_stat("waits")
+        if not slots.acquire(timeout=DB_POOL_TIMEOUT):
+            _db_stat("timeouts")
+            log.error("❌ Database pool exhausted after %ss", DB_POOL_TIMEOUT)
+            return None
+
+    try:
+        conn = pool.getconn()
+        # Server dropped the connection (restart, idle timeout, failover); after
+        # a restart every idle one is dead, and the pool opens a new one once
+        # they are gone
+        for _ in range(DB_POOL_MAX):
+            if _db_connection_alive(conn):
+                break
+            pool.putconn(conn, close=True)
+            _db_stat("reconnects")
+            conn = pool.getconn()
+        _db_stat("checkouts")
+        _db_stat("in_use")
+        return conn
+    except Exception as e:
+        slots.release()
+        _db_stat("errors")
+        log.error("❌ Database connection error: %s", e)
+        return None
+
+def release_db_connection(conn, broken=False):
+    """Return a connection to the pool, discarding it if it is unusable"""
+    global _db_pool_failed_at
+    if conn is None:
+        return
+    if broken:
+        # Its siblings likely lost the same server; check them before reuse
+        _db_pool_failed_at = time.monotonic()
+    pool = _get_db_pool()
+    _db_stat("checkins")
+    _db_stat("in_use", -1)
+    try:
+        if broken or conn.closed:
+            pool.putconn(conn, close=True)
+            return
+        if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        conn.last_used = time.monotonic()
+        pool.putconn(conn)
+    except Exception as e:
+        _db_stat("errors")
+        log.error("❌ Error releasing connection: %s", e)
+        try:
+            pool.putconn(conn, close=True)
+        except Exception:
+            pass
+    finally:
+        _db_pool_slots.release()
+
+@contextmanager
+def db_cursor():
+    """Yield a cursor on a pooled connection; commits on success.
+
+    Yields None when the database is unavailable so callers can fall back.
+    """
+    conn = get_db_connection()
+    if not conn:
+        yield None
+        return
+    db_transactions_total.inc()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            yield cursor
+        conn.commit()
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn, broken=broken)
+
+def get_db_pool_stats():
+    """Pool usage counters for this worker"""
+    with _db_stats_lock:
+        stats = dict(_db_pool_stats)
+    stats["pid"] = os.getpid()
+    stats["min"] = DB_POOL_MIN
+    stats["max"] = DB_POOL_MAX
+    pool = _db_pool if _db_pool_pid == os.getpid() else None
+    if pool is not None:
+        stats["idle"] = len(pool._pool)
+        stats["open"] = len(pool._pool) + len(pool._used)
+    else:
+        stats["idle"] = 0
+        stats["open"] = 0
+    return stats
+
 def init_db():
     """Initialize PostgreSQL database"""
     if not DATABASE_URL:
-        print("❌ DATABASE_URL not set!")
+        log.error("❌ DATABASE_URL not set!")
         return False
     
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with db_cursor() as cursor:
+            if cursor is None:
+                return False
             
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_payments (
-                user_id BIGINT,
-                semester TEXT,
-                paid_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, semester)
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                user_id BIGINT PRIMARY KEY,
-                semester TEXT,
-                nav_message_id BIGINT
-            )
-        ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_payments (
+                    user_id BIGINT,
+                    semester TEXT,
+                    paid_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, semester)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_sessions (
+                    user_id BIGINT PRIMARY KEY,
+                    semester TEXT,
+                    nav_message_id BIGINT
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_entitlements (
+                    user_id BIGINT PRIMARY KEY,
+                    semesters_mask SMALLINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS document_cache (
+                    file_path TEXT PRIMARY KEY,
+                    file_size BIGINT NOT NULL,
+                    file_mtime_ns BIGINT NOT NULL,
+                    file_id TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payment_links (
+                    user_id BIGINT,
+                    semester TEXT,
+                    link_id TEXT,
+                    short_url TEXT NOT NULL,
+                    expire_by BIGINT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (user_id, semester)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS job_runs (
+                    name TEXT PRIMARY KEY,
+                    last_run TIMESTAMP NOT NULL
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id BIGINT PRIMARY KEY,
+                    seen_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            
+            # Monthly partitions are added by EventLog as it writes; the
+            # default partition catches anything outside them
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_events (
+                    occurred_at TIMESTAMPTZ NOT NULL,
+                    kind TEXT NOT NULL,
+                    user_id BIGINT,
+                    semester TEXT,
+                    subject TEXT
+                ) PARTITION BY RANGE (occurred_at)
+            ''')
+            cursor.execute("CREATE TABLE IF NOT EXISTS bot_events_default PARTITION OF bot_events DEFAULT")
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS event_rollup_semester (
+                    day DATE NOT NULL,
+                    semester TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    count BIGINT NOT NULL,
+                    PRIMARY KEY (day, semester, kind)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS event_rollup_subject (
+                    day DATE NOT NULL,
+                    subject TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    count BIGINT NOT NULL,
+                    PRIMARY KEY (day, subject, kind)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value BIGINT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print("✅ PostgreSQL database initialized")
+        log.info("✅ PostgreSQL database initialized")
         return True
     except Exception as e:
-        print(f"❌ Database initialization error: {e}")
-        traceback.print_exc()
+        log.exception("❌ Database initialization error: %s", e)
         return False
 
+# -------------------------
+# Entitlement Cache
+# -------------------------
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "50000"))
+ENTITLEMENT_POSITIVE_TTL = float(os.getenv("ENTITLEMENT_POSITIVE_TTL", "86400"))
+ENTITLEMENT_NEGATIVE_TTL = float(os.getenv("ENTITLEMENT_NEGATIVE_TTL", "10"))
+# Where entitlements live: "rows" (user_payments), "dual" (write both,
+# read both) or "bitmap" (user_entitlements only). See migrate_entitlements.py.
+ENTITLEMENT_STORAGE = os.getenv("ENTITLEMENT_STORAGE", "rows")
+
+class EntitlementCache:
+    """LRU mirror of each user's entitlement bitmask, with separate TTLs.
+
+    Every user maps to the mask of semesters known to be paid and the mask
+    known to be unpaid, so a lookup is a single bit test. Payments grant
+    lifetime access, so paid bits are kept for a long time. Unpaid bits
+    expire quickly so a fresh payment is picked up even if it was recorded
+    by another worker.
+    """
+
+    def __init__(self, max_entries, positive_ttl, negative_ttl):
+        self.max_entries = max_entries
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        # user_id -> [paid_mask, paid_until, unpaid_mask, unpaid_until]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, user_id, semester):
+        """Return True/False for a cached answer, or None on a miss"""
+        bit = SEMESTER_BITS.get(semester, 0)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                if entry[0] & bit and entry[1] > now:
+                    self._entries.move_to_end(user_id)
+                    self.stats["hits"] += 1
+                    return True
+                if entry[2] & bit and entry[3] > now:
+                    self._entries.move_to_end(user_id)
+                    self.stats["hits"] += 1
+                    return False
+            self.stats["misses"] += 1
+            return None
+
+    def _entry(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            entry = self._entries[user_id] = [0, 0.0, 0, 0.0]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def set(self, user_id, semester, paid):
+        bit = SEMESTER_BITS.get(semester)
+        if not bit:
+            return
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(user_id)
+            if paid:
+                entry[0] |= bit
+                entry[1] = now + self.positive_ttl
+                entry[2] &= ~bit
+            else:
+                entry[2] |= bit
+                entry[3] = now + self.negative_ttl
+
+    def set_mask(self, user_id, mask):
+        """Cache a complete answer: mask is paid, everything else is unpaid"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entry(user_id)
+            entry[:] = [mask, now + self.positive_ttl, ALL_SEMESTERS_MASK & ~mask, now + self.negative_ttl]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["size"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+entitlement_cache = EntitlementCache(
+    ENTITLEMENT_CACHE_SIZE, ENTITLEMENT_POSITIVE_TTL, ENTITLEMENT_NEGATIVE_TTL
+)
+_entitlement_stats = {"dual_read_repairs": 0}
+
+def semesters_to_mask(semester_names):
+    mask = 0
+    for name in semester_names:
+        mask |= SEMESTER_BITS.get(name, 0)
+    return mask
+
+def mask_to_semesters(mask):
+    return {name for name, bit in SEMESTER_BITS.items() if mask & bit}
+
+def _resolve_entitlements(user_id, paid_rows, stored_mask):
+    """Combine user_payments rows and the bitmap according to ENTITLEMENT_STORAGE"""
+    rows_mask = semesters_to_mask(paid_rows or [])
+    stored_mask = stored_mask or 0
+    if ENTITLEMENT_STORAGE == "rows":
+        return rows_mask
+    if ENTITLEMENT_STORAGE == "bitmap":
+        return stored_mask
+
+    # Dual read: trust either source, and fill in bits the bitmap is missing
+    missing = rows_mask & ~stored_mask
+    if missing:
+        _entitlement_stats["dual_read_repairs"] += 1
+        log.warning("🔧 Repairing entitlement bitmap for user %s: +%s", user_id, missing)
+        _write_entitlement_bits(user_id, missing)
+    return rows_mask | stored_mask
+
+def _write_entitlement_bits(user_id, bits, cursor=None):
+    """OR bits into the user's row in user_entitlements; with a cursor, returns 1 if any bit was new"""
+    sql = """INSERT INTO user_entitlements (user_id, semesters_mask)
+             VALUES (%s, %s)
+             ON CONFLICT (user_id)
+             DO UPDATE SET semesters_mask = user_entitlements.semesters_mask | EXCLUDED.semesters_mask,
+                           updated_at = CURRENT_TIMESTAMP
+             WHERE (user_entitlements.semesters_mask & EXCLUDED.semesters_mask) <> EXCLUDED.semesters_mask"""
+    if cursor is not None:
+        cursor.execute(sql, (user_id, bits))
+        return cursor.rowcount
+    try:
+        with db_cursor() as cursor:
+            if cursor is not None:
+                cursor.execute(sql, (user_id, bits))
+    except Exception as e:
+        log.error("❌ Error writing entitlement bitmap: %s", e)
+
+@timed(db_seconds, "db")
 def is_semester_paid(user_id, semester):
     """Check if user has paid for a semester"""
+    bit = SEMESTER_BITS.get(semester)
+    if not bit:
+        return False
+
+    cached = entitlement_cache.get(user_id, semester)
+    if cached is not None:
+        return cached
+
+    state = get_active_user_state(user_id)
+    if state is not None:
+        return state.is_paid(semester)
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with db_cursor() as cursor:
+            if cursor is None:
+                return False
             
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT 1 FROM user_payments WHERE user_id = %s AND semester = %s",
-            (user_id, semester)
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                """SELECT ARRAY(SELECT semester FROM user_payments WHERE user_id = %s),
+                          (SELECT semesters_mask FROM user_entitlements WHERE user_id = %s)""",
+                (user_id, user_id)
+            )
+            paid_rows, stored_mask = cursor.fetchone()
         
-        is_paid = result is not None
-        print(f"💳 Payment check: user={user_id}, semester={semester}, paid={is_paid}")
+        mask = _resolve_entitlements(user_id, paid_rows, stored_mask)
+        entitlement_cache.set_mask(user_id, mask)
+        is_paid = bool(mask & bit)
+        payment_log.info("💳 Payment check: user=%s, semester=%s, paid=%s", user_id, semester, is_paid)
         return is_paid
     except Exception as e:
-        print(f"❌ Error checking payment: {e}")
-        traceback.print_exc()
+        log.exception("❌ Error checking payment: %s", e)
         return False
 
+@timed(db_seconds, "db")
 def mark_semester_paid(user_id, semester):
-    """Mark semester as paid for user"""
+    """Mark semester as paid for user; True only if it was not paid before"""
+    bit = SEMESTER_BITS.get(semester)
+    if ENTITLEMENT_STORAGE == "bitmap" and not bit:
+        log.error("❌ Unknown semester, cannot store in bitmap: %s", semester)
+        return False
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return False
+        with db_cursor() as cursor:
+            if cursor is None:
+                return False
             
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO user_payments (user_id, semester) VALUES (%s, %s) ON CONFLICT (user_id, semester) DO NOTHING",
-            (user_id, semester)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
-        print(f"✅ Marked {semester} as paid for user {user_id}")
-        return True
+            newly_paid = False
+            if ENTITLEMENT_STORAGE != "bitmap":
+                cursor.execute(
+                    "INSERT INTO user_payments (user_id, semester) VALUES (%s, %s) ON CONFLICT (user_id, semester) DO NOTHING",
+                    (user_id, semester)
+                )
+                newly_paid = cursor.rowcount > 0
+            if ENTITLEMENT_STORAGE != "rows" and bit:
+                newly_paid = _write_entitlement_bits(user_id, bit, cursor) > 0 or newly_paid
+            # Delivered to the other workers when this transaction commits
+            invalidation_bus.publish({"kind": "entitlement", "user_id": user_id, "semester": semester}, cursor)
+        entitlement_cache.set(user_id, semester, True)
+        state = get_active_user_state(user_id)
+        if state is not None:
+            state.paid.add(semester)
+        # Webhook and redirect both land here for one payment; count it once
+        if newly_paid:
+            event_log.record("payment_confirmed", user_id, semester)
+        log.info("✅ Marked %s as paid for user %s", semester, user_id)
+        return newly_paid
     except Exception as e:
-        print(f"❌ Error marking payment: {e}")
-        traceback.print_exc()
+        log.exception("❌ Error marking payment: %s", e)
         return False
 
+@timed(db_seconds, "db")
+def mark_semesters_paid(pairs):
+    """Batched mark_semester_paid; returns the (user_id, semester) pairs that were newly unlocked"""
+    pairs = {(user_id, semester) for user_id, semester in pairs if SEMESTER_BITS.get(semester)}
+    if not pairs:
+        return []
+
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return []
+
+            cursor.execute('''
+                SELECT u.id,
+                       ARRAY(SELECT semester FROM user_payments p WHERE p.user_id = u.id),
+                       (SELECT semesters_mask FROM user_entitlements e WHERE e.user_id = u.id)
+                FROM unnest(%s::bigint[]) AS u(id)
+            ''', (sorted({user_id for user_id, _ in pairs}),))
+            # A pair is new if any store the current mode writes to is missing it
+            stored = {}
+            for user_id, paid_rows, stored_mask in cursor.fetchall():
+                rows_mask, stored_mask = semesters_to_mask(paid_rows or []), stored_mask or 0
+                if ENTITLEMENT_STORAGE == "rows":
+                    stored[user_id] = rows_mask
+                elif ENTITLEMENT_STORAGE == "bitmap":
+                    stored[user_id] = stored_mask
+                else:
+                    stored[user_id] = rows_mask & stored_mask
+            new = sorted(pair for pair in pairs if not stored.get(pair[0], 0) & SEMESTER_BITS[pair[1]])
+            if not new:
+                return []
+
+            if ENTITLEMENT_STORAGE != "bitmap":
+                psycopg2.extras.execute_values(
+                    cursor,
+                    "INSERT INTO user_payments (user_id, semester) VALUES %s ON CONFLICT (user_id, semester) DO NOTHING",
+                    new,
+                )
+            if ENTITLEMENT_STORAGE != "rows":
+                bits = {}
+                for user_id, semester in new:
+                    bits[user_id] = bits.get(user_id, 0) | SEMESTER_BITS[semester]
+                psycopg2.extras.execute_values(
+                    cursor,
+                    """INSERT INTO user_entitlements (user_id, semesters_mask) VALUES %s
+                       ON CONFLICT (user_id)
+                       DO UPDATE SET semesters_mask = user_entitlements.semesters_mask | EXCLUDED.semesters_mask,
+                                     updated_at = CURRENT_TIMESTAMP""",
+                    list(bits.items()),
+                )
+            for user_id, semester in new:
+                invalidation_bus.publish({"kind": "entitlement", "user_id": user_id, "semester": semester}, cursor)
+
+        for user_id, semester in new:
+            entitlement_cache.set(user_id, semester, True)
+            state = get_active_user_state(user_id)
+            if state is not None:
+                state.paid.add(semester)
+            event_log.record("payment_confirmed", user_id, semester)
+        log.info("✅ Marked %s semesters paid for %s users", len(new), len({user_id for user_id, _ in new}))
+        return new
+    except Exception as e:
+        log.exception("❌ Error marking payments: %s", e)
+        return []
+
+def _semester_bit_case():
+    """SQL CASE mapping user_payments.semester to its bit, plus parameters"""
+    whens = " ".join("WHEN %s THEN %s" for _ in SEMESTER_BITS)
+    params = [value for item in SEMESTER_BITS.items() for value in item]
+    return f"CASE semester {whens} ELSE 0 END", params
+
+def backfill_entitlement_bitmap():
+    """Copy user_payments into user_entitlements; safe to re-run"""
+    case_sql, params = _semester_bit_case()
+    with db_cursor() as cursor:
+        if cursor is None:
+            raise RuntimeError("database unavailable")
+        
+        cursor.execute(
+            f"""INSERT INTO user_entitlements (user_id, semesters_mask)
+                SELECT user_id, bit_or({case_sql})::smallint
+                FROM user_payments
+                GROUP BY user_id
+                ON CONFLICT (user_id)
+                DO UPDATE SET semesters_mask = user_entitlements.semesters_mask | EXCLUDED.semesters_mask,
+                              updated_at = CURRENT_TIMESTAMP""",
+            params
+        )
+        users = cursor.rowcount
+        
+        cursor.execute(
+            "SELECT semester, COUNT(*) FROM user_payments WHERE NOT (semester = ANY(%s)) GROUP BY semester",
+            (list(SEMESTER_BITS),)
+        )
+        unknown = dict(cursor.fetchall())
+    return {"users": users, "unknown_semesters": unknown}
+
+def verify_entitlement_bitmap(limit=100):
+    """Users whose bitmap differs from their user_payments rows"""
+    case_sql, params = _semester_bit_case()
+    with db_cursor() as cursor:
+        if cursor is None:
+            raise RuntimeError("database unavailable")
+        
+        cursor.execute(
+            f"""WITH r AS (
+                    SELECT user_id, bit_or({case_sql})::smallint AS mask
+                    FROM user_payments
+                    GROUP BY user_id
+                )
+                SELECT COALESCE(r.user_id, e.user_id), COALESCE(r.mask, 0), COALESCE(e.semesters_mask, 0)
+                FROM r
+                FULL OUTER JOIN user_entitlements e ON e.user_id = r.user_id
+                WHERE COALESCE(r.mask, 0) <> COALESCE(e.semesters_mask, 0)
+                LIMIT %s""",
+            params + [limit]
+        )
+        return [
+            {"user_id": user_id, "rows_mask": rows_mask, "bitmap_mask": bitmap_mask}
+            for user_id, rows_mask, bitmap_mask in cursor.fetchall()
+        ]
+
 def save_user_session(user_id, semester, nav_message_id=None):
     """Save user session data"""
+    state = get_active_user_state(user_id)
+    if state is not None:
+        # Written once when the update finishes
+        state.set_session(semester, nav_message_id)
+        return
+    _store_user_session(user_id, semester, nav_message_id)
+
+def _store_user_session(user_id, semester, nav_message_id):
+    if SESSION_WRITE_BEHIND:
+        session_buffer.put(user_id, semester, nav_message_id)
+        return
+    _write_user_session(user_id, semester, nav_message_id)
+
+@timed(db_seconds, "db")
+def _write_user_session(user_id, semester, nav_message_id):
     try:
-        conn = get_db_connection()
-        if not conn:
-            return
+        with db_cursor() as cursor:
+            if cursor is None:
+                return
             
-        cursor = conn.cursor()
-        cursor.execute(
-            """INSERT INTO user_sessions (user_id, semester, nav_message_id) 
-               VALUES (%s, %s, %s) 
-               ON CONFLICT (user_id) 
-               DO UPDATE SET semester = %s, nav_message_id = %s""",
-            (user_id, semester, nav_message_id, semester, nav_message_id)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                """INSERT INTO user_sessions (user_id, semester, nav_message_id) 
+                   VALUES (%s, %s, %s) 
+                   ON CONFLICT (user_id) 
+                   DO UPDATE SET semester = %s, nav_message_id = %s""",
+                (user_id, semester, nav_message_id, semester, nav_message_id)
+            )
     except Exception as e:
-        print(f"❌ Error saving session: {e}")
-        traceback.print_exc()
+        log.exception("❌ Error saving session: %s", e)
 
+@timed(db_seconds, "db")
 def get_user_session(user_id):
     """Get user session data"""
+    state = get_active_user_state(user_id)
+    if state is not None:
+        return state.get_session()
+
+    buffered = session_buffer.get(user_id)
+    if buffered is not None:
+        return buffered
+
     try:
-        conn = get_db_connection()
-        if not conn:
-            return {}
+        with db_cursor() as cursor:
+            if cursor is None:
+                return {}
             
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT semester, nav_message_id FROM user_sessions WHERE user_id = %s",
-            (user_id,)
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        conn.close()
+            cursor.execute(
+                "SELECT semester, nav_message_id FROM user_sessions WHERE user_id = %s",
+                (user_id,)
+            )
+            result = cursor.fetchone()
         
         if result:
             return {"semester": result[0], "nav_message_id": result[1]}
         return {}
     except Exception as e:
-        print(f"❌ Error getting session: {e}")
-        traceback.print_exc()
+        log.exception("❌ Error getting session: %s", e)
         return {}
 
+# -------------------------
+# Cross-worker Invalidation
+# -------------------------
+class InvalidationBus:
+    """Keeps per-worker caches in step using Postgres LISTEN/NOTIFY.
+
+    Writers publish a small JSON message inside their transaction. Every
+    worker holds one dedicated LISTEN connection on a background thread
+    and applies messages to its local caches. Notifications sent while a
+    listener is disconnected are lost, so after reconnecting it drops
+    its caches and rebuilds from the database.
+    """
+
+    def __init__(self, channel, enabled):
+        self.channel = channel
+        self.enabled = enabled
+        self._pid = None
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "received": 0, "reconnects": 0, "resyncs": 0, "connected": False}
+
+    def publish(self, message, cursor=None):
+        """NOTIFY all workers; with a cursor it goes out on commit"""
+        if not self.enabled:
+            return
+        payload = json.dumps(message)
+        try:
+            if cursor is not None:
+                cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+            else:
+                with db_cursor() as own_cursor:
+                    if own_cursor is None:
+                        return
+                    own_cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+            self.stats["published"] += 1
+        except Exception as e:
+            log.error("❌ Error publishing invalidation: %s", e)
+            if cursor is not None:
+                raise
+
+    def ensure_started(self):
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="invalidation-listener", daemon=True).start()
+
+    def _run(self):
+        backoff = 1
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL, connect_timeout=10)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with conn.cursor() as cursor:
+                    cursor.execute(f'LISTEN "{self.channel}"')
+                self.stats["connected"] = True
+                if not first:
+                    self.stats["reconnects"] += 1
+                    self._resync()
+                first = False
+                backoff = 1
+                log.info("📡 Listening for cache invalidations on %s", self.channel)
+
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        # Idle: make sure the connection is still alive
+                        with conn.cursor() as cursor:
+                            cursor.execute("SELECT 1")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._apply(notify.payload)
+            except Exception as e:
+                self.stats["connected"] = False
+                log.error("❌ Invalidation listener error: %s, reconnecting in %ss", e, backoff)
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    def _apply(self, payload):
+        self.stats["received"] += 1
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            log.warning("⚠️ Ignoring malformed invalidation: %s", payload)
+            return
+        kind = message.get("kind")
+        if kind == "entitlement":
+            entitlement_cache.set(message["user_id"], message["semester"], True)
+        elif kind == "catalog":
+            reload_catalog()
+
+    def _resync(self):
+        """Forget everything that may have changed while disconnected"""
+        self.stats["resyncs"] += 1
+        entitlement_cache.clear()
+        reload_catalog()
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats["enabled"] = self.enabled
+        return stats
+
+invalidation_bus = InvalidationBus(INVALIDATION_CHANNEL, bool(DATABASE_URL) and INVALIDATION_BUS)
+
+# -------------------------
+# Session Write-Behind
+# -------------------------
+class SessionWriteBehind:
+    """Coalesces session writes in memory and upserts them in batches.
+
+    Only the latest (semester, nav_message_id) per user is kept. A
+    background thread writes the batch every SESSION_FLUSH_INTERVAL_MS or
+    as soon as SESSION_FLUSH_MAX users are pending.
+
+    Reads in this worker see pending writes, but other gunicorn workers
+    read Postgres. A user's next tap that lands on another worker within
+    the flush interval gets their previous session: back buttons go to the
+    older screen, and the stale nav message is edited instead of the new
+    one. The short default interval keeps that window below typical tap
+    spacing while still batching bursts.
+    """
+
+    def __init__(self, interval, max_pending):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        # Batch being written; still visible to readers until committed
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.stats = {"writes": 0, "coalesced": 0, "flushes": 0, "rows_written": 0, "errors": 0}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="session-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, user_id, semester, nav_message_id):
+        with self._lock:
+            self._ensure_started()
+            if user_id in self._pending:
+                self.stats["coalesced"] += 1
+            self._pending[user_id] = (semester, nav_message_id)
+            self.stats["writes"] += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def get(self, user_id):
+        """Buffered session for user_id, or None if nothing is pending"""
+        with self._lock:
+            pending = self._pending.get(user_id) or self._inflight.get(user_id)
+        if pending is None:
+            return None
+        return {"semester": pending[0], "nav_message_id": pending[1]}
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write all pending sessions in one multi-row upsert"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+        if not batch or not DATABASE_URL:
+            self._inflight = {}
+            return
+        rows = [(user_id, sem, nav) for user_id, (sem, nav) in batch.items()]
+        try:
+            self._write(rows)
+            with self._lock:
+                self._inflight = {}
+                self.stats["flushes"] += 1
+                self.stats["rows_written"] += len(rows)
+        except Exception as e:
+            log.error("❌ Error flushing %s sessions: %s", len(rows), e)
+            with self._lock:
+                self._inflight = {}
+                self.stats["errors"] += 1
+                # Keep the batch for the next attempt unless a newer value arrived
+                for user_id, value in batch.items():
+                    self._pending.setdefault(user_id, value)
+
+    # Timed here rather than on flush so idle ticks don't fill the histogram
+    @timed(db_seconds, "db")
+    def _write(self, rows):
+        with db_cursor() as cursor:
+            if cursor is None:
+                raise RuntimeError("database unavailable")
+            
+            psycopg2.extras.execute_values(
+                cursor,
+                """INSERT INTO user_sessions (user_id, semester, nav_message_id)
+                   VALUES %s
+                   ON CONFLICT (user_id)
+                   DO UPDATE SET semester = EXCLUDED.semester,
+                                 nav_message_id = EXCLUDED.nav_message_id""",
+                rows
+            )
+
+    def shutdown(self):
+        if self._pid == os.getpid():
+            self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["pending"] = len(self._pending)
+        return stats
+
+session_buffer = SessionWriteBehind(SESSION_FLUSH_INTERVAL_MS / 1000, SESSION_FLUSH_MAX)
+atexit.register(session_buffer.shutdown)
+
+# -------------------------
+# Event Log
+# -------------------------
+class EventLog:
+    """Analytics events buffered in memory and written in the background.
+
+    record() only appends to a bounded ring buffer, so handlers never wait
+    on the database. When the buffer is full the oldest events are dropped
+    and counted. A background thread COPYs each batch into the monthly
+    partition of bot_events. In the same transaction it adds the batch's
+    per-day counts to event_rollup_semester and event_rollup_subject.
+    """
+
+    def __init__(self, capacity, interval, max_pending, enabled=True):
+        self.interval = interval
+        self.max_pending = max_pending
+        self.enabled = enabled
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._partitions = set()
+        self.stats = {"recorded": 0, "dropped": 0, "flushes": 0, "rows_written": 0, "errors": 0}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, name="event-writer", daemon=True).start()
+
+    def record(self, kind, user_id=None, semester=None, subject=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._ensure_started()
+            if len(self._events) == self._events.maxlen:
+                self.stats["dropped"] += 1
+            self._events.append((time.time(), kind, user_id, semester, subject))
+            self.stats["recorded"] += 1
+            full = len(self._events) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _ensure_partitions(self, months):
+        for year, month in months - self._partitions:
+            next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+            try:
+                with db_cursor() as cursor:
+                    if cursor is None:
+                        return
+                    cursor.execute(
+                        f"""CREATE TABLE IF NOT EXISTS bot_events_{year}_{month:02d} PARTITION OF bot_events
+                            FOR VALUES FROM ('{year}-{month:02d}-01') TO ('{next_year}-{next_month:02d}-01')"""
+                    )
+                self._partitions.add((year, month))
+            except Exception as e:
+                # e.g. the default partition already holds rows for this month
+                log.error("❌ Error creating events partition %s-%02d: %s", year, month, e)
+                self._partitions.add((year, month))
+
+    def flush(self):
+        """Write everything buffered; a failed batch is dropped, not retried"""
+        with self._lock:
+            batch = list(self._events)
+            self._events.clear()
+        if not batch or not DATABASE_URL:
+            return
+
+        months = set()
+        semester_counts = {}
+        subject_counts = {}
+        rows = io.StringIO()
+        writer = csv.writer(rows)
+        for occurred_at, kind, user_id, semester, subject in batch:
+            moment = time.gmtime(occurred_at)
+            months.add((moment.tm_year, moment.tm_mon))
+            day = time.strftime("%Y-%m-%d", moment)
+            if semester:
+                key = (day, semester, kind)
+                semester_counts[key] = semester_counts.get(key, 0) + 1
+            if subject:
+                key = (day, subject, kind)
+                subject_counts[key] = subject_counts.get(key, 0) + 1
+            timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", moment) + f".{int(occurred_at % 1 * 1e6):06d}+00:00"
+            writer.writerow((timestamp, kind, user_id, semester, subject))
+        rows.seek(0)
+
+        self._ensure_partitions(months)
+        try:
+            self._write(rows, semester_counts, subject_counts)
+            with self._lock:
+                self.stats["flushes"] += 1
+                self.stats["rows_written"] += len(batch)
+        except Exception as e:
+            log.error("❌ Error writing %s events: %s", len(batch), e)
+            with self._lock:
+                self.stats["errors"] += 1
+                self.stats["dropped"] += len(batch)
+
+    # Timed here rather than on flush so idle ticks don't fill the histogram
+    @timed(db_seconds, "db")
+    def _write(self, rows, semester_counts, subject_counts):
+        with db_cursor() as cursor:
+            if cursor is None:
+                raise RuntimeError("database unavailable")
+            
+            cursor.copy_expert(
+                "COPY bot_events (occurred_at, kind, user_id, semester, subject) FROM STDIN WITH (FORMAT csv)",
+                rows,
+            )
+            for table, column, counts in (
+                ("event_rollup_semester", "semester", semester_counts),
+                ("event_rollup_subject", "subject", subject_counts),
+            ):
+                if not counts:
+                    continue
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f"""INSERT INTO {table} (day, {column}, kind, count) VALUES %s
+                        ON CONFLICT (day, {column}, kind)
+                        DO UPDATE SET count = {table}.count + EXCLUDED.count""",
+                    [key + (count,) for key, count in counts.items()],
+                )
+
+    def shutdown(self):
+        if self._pid == os.getpid():
+            self.flush()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["buffered"] = len(self._events)
+            stats["capacity"] = self._events.maxlen
+        stats["enabled"] = self.enabled
+        return stats
+
+event_log = EventLog(EVENT_BUFFER_SIZE, EVENT_FLUSH_INTERVAL_MS / 1000, EVENT_FLUSH_MAX, EVENT_LOG)
+atexit.register(event_log.shutdown)
+
+def get_event_rollups(days=7):
+    """Per-semester and per-subject event counts for the last days, newest first"""
+    with db_cursor() as cursor:
+        if cursor is None:
+            return None
+        result = {}
+        for table, column in (("event_rollup_semester", "semester"), ("event_rollup_subject", "subject")):
+            cursor.execute(
+                f"""SELECT day, {column}, kind, count FROM {table}
+                    WHERE day > CURRENT_DATE - %s
+                    ORDER BY day DESC, count DESC""",
+                (days,),
+            )
+            result[column] = [
+                {"day": day.isoformat(), column: name, "kind": kind, "count": count}
+                for day, name, kind, count in cursor.fetchall()
+            ]
+        return result
+
+# -------------------------
+# Per-update User State
+# -------------------------
+_active_user_state = threading.local()
+
+class UserState:
+    """Session and entitlements of one user for the duration of an update.
+
+    The first read loads the session row and every paid semester in a
+    single query; session writes are kept here and stored once by flush().
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.loaded = False
+        self.session = {}
+        self.paid = set()
+        self.dirty = False
+
+    @timed(db_seconds, "db")
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with db_cursor() as cursor:
+                if cursor is None:
+                    return
+                
+                cursor.execute(
+                    """SELECT s.semester, s.nav_message_id,
+                              ARRAY(SELECT p.semester FROM user_payments p WHERE p.user_id = %s),
+                              (SELECT e.semesters_mask FROM user_entitlements e WHERE e.user_id = %s)
+                       FROM (SELECT 1) AS one
+                       LEFT JOIN user_sessions s ON s.user_id = %s""",
+                    (self.user_id, self.user_id, self.user_id)
+                )
+                result = cursor.fetchone()
+        except Exception as e:
+            log.exception("❌ Error loading user state: %s", e)
+            return
+
+        semester, nav_message_id, paid_rows, stored_mask = result
+        buffered = session_buffer.get(self.user_id)
+        if self.dirty:
+            pass
+        elif buffered is not None:
+            self.session = buffered
+        elif semester is not None:
+            self.session = {"semester": semester, "nav_message_id": nav_message_id}
+        mask = _resolve_entitlements(self.user_id, paid_rows, stored_mask)
+        self.paid = mask_to_semesters(mask)
+        entitlement_cache.set_mask(self.user_id, mask)
+
+    def is_paid(self, semester):
+        self.load()
+        return semester in self.paid
+
+    def get_session(self):
+        if not self.dirty:
+            self.load()
+        return dict(self.session)
+
+    def set_session(self, semester, nav_message_id):
+        self.session = {"semester": semester, "nav_message_id": nav_message_id}
+        self.dirty = True
+
+    def flush(self):
+        if self.dirty:
+            _store_user_session(self.user_id, self.session["semester"], self.session["nav_message_id"])
+            self.dirty = False
+
+def get_active_user_state(user_id):
+    """UserState of the update being handled on this thread, if any"""
+    state = getattr(_active_user_state, "state", None)
+    if state is not None and state.user_id == user_id:
+        return state
+    return None
+
+@contextmanager
+def user_state(user_id):
+    """Scope session reads and writes for user_id to one unit of work"""
+    state = UserState(user_id)
+    _active_user_state.state = state
+    try:
+        yield state
+    finally:
+        _active_user_state.state = None
+        state.flush()
+
+# -------------------------
+# Telegram file_id cache
+# -------------------------
+# path -> (size, mtime_ns, file_id); mirrors the document_cache table
+_file_id_cache = {}
+
+def get_file_signature(file_path):
+    """Size and mtime used to detect a changed PDF"""
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns
+
+@timed(db_seconds, "db")
+def get_cached_file_id(file_path, signature):
+    """Return the Telegram file_id for an unchanged file, or None"""
+    cached = _file_id_cache.get(file_path)
+    if cached:
+        if cached[:2] == signature:
+            return cached[2]
+        # PDF was replaced on disk; the old file_id points at stale content
+        invalidate_file_id(file_path)
+        return None
+
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return None
+            
+            cursor.execute(
+                "SELECT file_size, file_mtime_ns, file_id FROM document_cache WHERE file_path = %s",
+                (file_path,)
+            )
+            result = cursor.fetchone()
+    except Exception as e:
+        log.error("❌ Error reading file_id cache: %s", e)
+        return None
+
+    if not result:
+        return None
+    if (result[0], result[1]) != signature:
+        invalidate_file_id(file_path)
+        return None
+    _file_id_cache[file_path] = (result[0], result[1], result[2])
+    return result[2]
+
+@timed(db_seconds, "db")
+def store_file_id(file_path, signature, file_id):
+    """Remember the file_id Telegram assigned to an uploaded file"""
+    _file_id_cache[file_path] = (signature[0], signature[1], file_id)
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return
+            
+            cursor.execute(
+                """INSERT INTO document_cache (file_path, file_size, file_mtime_ns, file_id)
+                   VALUES (%s, %s, %s, %s)
+                   ON CONFLICT (file_path)
+                   DO UPDATE SET file_size = EXCLUDED.file_size,
+                                 file_mtime_ns = EXCLUDED.file_mtime_ns,
+                                 file_id = EXCLUDED.file_id,
+                                 updated_at = CURRENT_TIMESTAMP""",
+                (file_path, signature[0], signature[1], file_id)
+            )
+    except Exception as e:
+        log.error("❌ Error saving file_id: %s", e)
+
+@timed(db_seconds, "db")
+def invalidate_file_id(file_path):
+    """Drop a cached file_id so the next send uploads the file again"""
+    _file_id_cache.pop(file_path, None)
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return
+            
+            cursor.execute("DELETE FROM document_cache WHERE file_path = %s", (file_path,))
+    except Exception as e:
+        log.error("❌ Error invalidating file_id: %s", e)
+
+# -------------------------
+# Payment Link Cache
+# -------------------------
+PAYMENT_LINK_TTL = int(os.getenv("PAYMENT_LINK_TTL", str(7 * 24 * 3600)))
+# Don't hand out a link that expires before the user can finish paying
+PAYMENT_LINK_MIN_REMAINING = int(os.getenv("PAYMENT_LINK_MIN_REMAINING", "1800"))
+PAYMENT_LINK_CACHE_SIZE = int(os.getenv("PAYMENT_LINK_CACHE_SIZE", "10000"))
+
+class SingleFlight:
+    """Collapse concurrent calls for the same key into one execution"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "result": None}
+                self._calls[key] = call
+        if not leader:
+            call["event"].wait()
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call["event"].set()
+
+# (user_id, semester) -> {"id", "short_url", "expire_by"}
+_payment_link_cache = OrderedDict()
+_payment_link_cache_lock = threading.Lock()
+_payment_link_flight = SingleFlight()
+_payment_link_stats = {"reused": 0, "created": 0}
+
+def _remember_payment_link(user_id, semester, link):
+    with _payment_link_cache_lock:
+        _payment_link_cache[(user_id, semester)] = link
+        _payment_link_cache.move_to_end((user_id, semester))
+        while len(_payment_link_cache) > PAYMENT_LINK_CACHE_SIZE:
+            _payment_link_cache.popitem(last=False)
+
+@timed(db_seconds, "db")
+def _load_payment_link(user_id, semester):
+    """Stored link for (user, semester), from memory or the database"""
+    with _payment_link_cache_lock:
+        link = _payment_link_cache.get((user_id, semester))
+    if link:
+        return link
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return None
+            
+            cursor.execute(
+                "SELECT link_id, short_url, expire_by FROM payment_links WHERE user_id = %s AND semester = %s",
+                (user_id, semester)
+            )
+            result = cursor.fetchone()
+    except Exception as e:
+        log.error("❌ Error loading payment link: %s", e)
+        return None
+    if not result:
+        return None
+    link = {"id": result[0], "short_url": result[1], "expire_by": result[2]}
+    _remember_payment_link(user_id, semester, link)
+    return link
+
+@timed(db_seconds, "db")
+def _save_payment_link(user_id, semester, link):
+    _remember_payment_link(user_id, semester, link)
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return
+            
+            cursor.execute(
+                """INSERT INTO payment_links (user_id, semester, link_id, short_url, expire_by)
+                   VALUES (%s, %s, %s, %s, %s)
+                   ON CONFLICT (user_id, semester)
+                   DO UPDATE SET link_id = EXCLUDED.link_id,
+                                 short_url = EXCLUDED.short_url,
+                                 expire_by = EXCLUDED.expire_by,
+                                 created_at = CURRENT_TIMESTAMP""",
+                (user_id, semester, link["id"], link["short_url"], link["expire_by"])
+            )
+    except Exception as e:
+        log.error("❌ Error saving payment link: %s", e)
+
+def get_payment_link(amount, semester, user_id, chat_id):
+    """Reuse the user's active payment link for a semester, creating one if needed.
+
+    Concurrent taps for the same (user, semester) share a single Razorpay
+    call instead of each minting a link.
+    """
+    def load_or_create():
+        link = _load_payment_link(user_id, semester)
+        if link and link["expire_by"] - time.time() > PAYMENT_LINK_MIN_REMAINING:
+            _payment_link_stats["reused"] += 1
+            return link
+
+        expire_by = int(time.time()) + PAYMENT_LINK_TTL
+        data = create_razorpay_payment_link(amount, semester, user_id, chat_id, expire_by)
+        if not data or "short_url" not in data:
+            return data
+        _payment_link_stats["created"] += 1
+        link = {"id": data.get("id"), "short_url": data["short_url"], "expire_by": expire_by}
+        _save_payment_link(user_id, semester, link)
+        return link
+
+    return _payment_link_flight.do((user_id, semester), load_or_create)
+
+def get_payment_link_stats():
+    with _payment_link_cache_lock:
+        return {**_payment_link_stats, "cached": len(_payment_link_cache)}
+
 # -------------------------
 # Semester-subject mapping
 # -------------------------
@@ -226,6 +1774,376 @@ semesters = {
     ],
 }
 
+# -------------------------
+# HTTP Clients
+# -------------------------
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+
+# Telegram flood limits: ~30 messages/s overall, ~1 message/s per chat
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "5"))
+TELEGRAM_UPLOAD_LANES = int(os.getenv("TELEGRAM_UPLOAD_LANES", "2"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", "30"))
+
+class PooledHTTPClient:
+    """Keep-alive HTTP client for one upstream host.
+
+    Wraps a requests.Session whose urllib3 pool keeps connections open
+    between calls. The session is rebuilt after a fork so gunicorn workers
+    never share sockets.
+    """
+
+    def __init__(self, base_url, pool_size=HTTP_POOL_SIZE, auth=None, timeout=10):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.auth = auth
+        self.timeout = timeout
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is not None and self._pid == os.getpid():
+            return self._session
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size, pool_block=False)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                if self.auth:
+                    session.auth = self.auth
+                self._session = session
+                self._pid = os.getpid()
+        return self._session
+
+    def request(self, method, path, timeout=None, histogram=None, label=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.session.request(
+                method, self.base_url + path, timeout=timeout or self.timeout, **kwargs
+            )
+        except Exception:
+            if histogram is not None:
+                errors_total.inc((histogram.name, label or path))
+            raise
+        finally:
+            if histogram is not None:
+                histogram.observe((label or path,), time.perf_counter() - start)
+
+    def connection_stats(self):
+        """Requests vs new connections per host; the difference is reuse"""
+        stats = {}
+        if self._session is None or self._pid != os.getpid():
+            return stats
+        for adapter in set(self._session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                host = stats.setdefault(pool.host, {"requests": 0, "connections": 0})
+                host["requests"] += pool.num_requests
+                host["connections"] += pool.num_connections
+        for host in stats.values():
+            host["reused"] = max(0, host["requests"] - host["connections"])
+        return stats
+
+class TokenBucket:
+    """Token bucket that hands out reservations instead of refusing.
+
+    reserve() always takes a token, letting the balance go negative, and
+    returns how long the caller must sleep before using it. Callers are
+    therefore spaced out in arrival order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.not_before = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.not_before - now)
+
+    def delay(self):
+        """Seconds left on a pause, without taking a token"""
+        with self._lock:
+            return max(0.0, self.not_before - time.monotonic())
+
+    def pause(self, seconds):
+        """Hold every caller back, e.g. for Telegram's retry_after"""
+        with self._lock:
+            self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+class OutboundScheduler:
+    """Paces Bot API calls to stay under Telegram's flood limits.
+
+    Message-producing calls take a token from a global bucket and from a
+    per-chat bucket, sleeping until their slot comes up. Uploads also need
+    a slot in a small upload lane, so a few large files can't occupy every
+    sender while short edits wait behind them.
+    """
+
+    def __init__(self, global_rate, chat_rate, chat_burst, upload_lanes, max_chats=10000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.upload_lane = threading.BoundedSemaphore(upload_lanes)
+        self._chats = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "calls": 0,
+            "delayed": 0,
+            "delay_seconds": 0.0,
+            "throttled": 0,
+            "retries": 0,
+            "gave_up": 0,
+        }
+
+    def _chat_bucket(self, chat_id):
+        with self._lock:
+            bucket = self._chats.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+                self._chats[chat_id] = bucket
+                if len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+            else:
+                self._chats.move_to_end(chat_id)
+            return bucket
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def wait_for_slot(self, chat_id, per_chat=True):
+        """Block until both the global and the chat bucket allow a call.
+
+        Without per_chat the call spends no chat token but still waits out
+        a pause on its chat.
+        """
+        wait = self.global_bucket.reserve()
+        if chat_id is not None:
+            bucket = self._chat_bucket(chat_id)
+            wait = max(wait, bucket.reserve() if per_chat else bucket.delay())
+        self.count("calls")
+        if wait > 0:
+            self.count("delayed")
+            self.count("delay_seconds", wait)
+            time.sleep(wait)
+
+    def throttled(self, chat_id, retry_after):
+        """Record a 429 and hold back further calls for retry_after seconds"""
+        self.count("throttled")
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(retry_after)
+        else:
+            self.global_bucket.pause(retry_after)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["tracked_chats"] = len(self._chats)
+        return stats
+
+class TelegramClient(PooledHTTPClient):
+    """Bot API client with per-method timeouts and flood control"""
+
+    TIMEOUTS = {
+        "sendDocument": 60,
+        "sendMediaGroup": 90,
+        "answerCallbackQuery": 5,
+        "deleteMessage": 5,
+        "getMe": 5,
+    }
+
+    # Calls that count against Telegram's global flood limit
+    RATE_LIMITED = {"sendMessage", "editMessageText", "sendDocument", "sendMediaGroup", "deleteMessage"}
+    # Calls that add a new message to the chat and count per chat as well
+    CHAT_RATE_LIMITED = {"sendMessage", "sendDocument", "sendMediaGroup"}
+
+    def __init__(self, token, pool_size=HTTP_POOL_SIZE, scheduler=None):
+        super().__init__(f"{TELEGRAM_API_URL}/bot{token}", pool_size=pool_size)
+        self.scheduler = scheduler
+
+    def call(self, method, data=None, files=None, timeout=None):
+        """Call a Bot API method and return the decoded JSON response.
+
+        Rate-limited methods wait for a slot and are retried when Telegram
+        answers 429 with parameters.retry_after.
+        """
+        if self.scheduler is None or method not in self.RATE_LIMITED:
+            return self._post(method, data, files, timeout)
+
+        # The chat is known for edits and deletes too, so a 429 on one only
+        # pauses that chat; only chat-less calls pause the whole worker
+        chat_id = (data or {}).get("chat_id")
+        if files:
+            with self.scheduler.upload_lane:
+                return self._call_scheduled(method, data, files, timeout, chat_id)
+        return self._call_scheduled(method, data, files, timeout, chat_id)
+
+    def _call_scheduled(self, method, data, files, timeout, chat_id):
+        per_chat = method in self.CHAT_RATE_LIMITED
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            self.scheduler.wait_for_slot(chat_id, per_chat)
+            response_data = self._post(method, data, files, timeout)
+            if response_data.get('error_code') != 429:
+                return response_data
+
+            retry_after = response_data.get('parameters', {}).get('retry_after', 1)
+            self.scheduler.throttled(chat_id, retry_after)
+            if attempt == TELEGRAM_MAX_RETRIES or retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                break
+            log.warning("⏳ %s throttled for chat %s, retrying in %ss", method, chat_id, retry_after)
+            self.scheduler.count("retries")
+            if files:
+                for f in files.values():
+                    f.seek(0)
+        self.scheduler.count("gave_up")
+        log.error("❌ %s dropped after Telegram throttling: %s", method, response_data)
+        return response_data
+
+    def _post(self, method, data, files, timeout):
+        timeout = timeout or self.TIMEOUTS.get(method, self.timeout)
+        metric = {"histogram": telegram_seconds, "label": method}
+        if files:
+            response = self.request("POST", f"/{method}", timeout=timeout, data=data, files=files, **metric)
+        else:
+            response = self.request("POST", f"/{method}", timeout=timeout, json=data or {}, **metric)
+        response_data = response.json()
+        if not response_data.get('ok'):
+            errors_total.inc(("telegram", f"{method}:{response_data.get('error_code')}"))
+        return response_data
+
+outbound_scheduler = OutboundScheduler(
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_UPLOAD_LANES
+)
+telegram = TelegramClient(TOKEN, scheduler=outbound_scheduler)
+razorpay = PooledHTTPClient(
+    f"{RAZORPAY_API_URL}/v1",
+    pool_size=4,
+    auth=(RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET),
+)
+
+_io_executor = None
+_io_executor_pid = None
+
+def run_async(fn, *args, **kwargs):
+    """Run an independent outbound call on the shared I/O thread pool"""
+    global _io_executor, _io_executor_pid
+    if _io_executor_pid != os.getpid():
+        # Executor threads do not survive a fork; build one per worker
+        _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+        _io_executor_pid = os.getpid()
+    return _io_executor.submit(fn, *args, **kwargs)
+
+def get_http_stats():
+    """Connection reuse counters for all upstreams"""
+    return {**telegram.connection_stats(), **razorpay.connection_stats()}
+
+# Stable semester -> bit mapping for user_entitlements.semesters_mask.
+# Bits follow the order above: only ever append semesters, never reorder.
+SEMESTER_BITS = {semester: 1 << i for i, semester in enumerate(semesters)}
+ALL_SEMESTERS_MASK = (1 << len(SEMESTER_BITS)) - 1
+
+# -------------------------
+# Render Memo
+# -------------------------
+RENDER_MEMO_SIZE = int(os.getenv("RENDER_MEMO_SIZE", "20000"))
+
+def render_digest(text, reply_markup):
+    """Digest of what we ask Telegram to show"""
+    return hashlib.blake2b(f"{text}\0{reply_markup or ''}".encode(), digest_size=16).digest()
+
+def rendered_fingerprint(message):
+    """Digest of a message as Telegram reports it, in API results and in callback updates alike"""
+    snapshot = json.dumps([message.get("text"), message.get("reply_markup")], sort_keys=True)
+    return hashlib.blake2b(snapshot.encode(), digest_size=16).digest()
+
+class RenderMemo:
+    """Remembers the screen each bot message currently shows.
+
+    Maps (chat_id, message_id) to the digest of the text and markup we last
+    applied, and to Telegram's rendering of the result. edit_message skips
+    the API call when asked to apply the same digest again, but only to the
+    message the callback being handled was tapped on. That callback carries
+    a snapshot of the message, and an entry whose rendering differs from it
+    is dropped first. Any other message, such as the nav message found via
+    the session, may have been edited by another worker, so edits to it
+    always go out.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._observed = threading.local()
+        self.stats = {"skipped": 0, "remembered": 0, "invalidated": 0}
+
+    def is_current(self, key, digest):
+        if key != getattr(self._observed, "key", None):
+            return False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != digest:
+                return False
+            self._entries.move_to_end(key)
+            self.stats["skipped"] += 1
+        return True
+
+    def remember(self, key, digest, message):
+        if not isinstance(message, dict):
+            return
+        with self._lock:
+            self._entries[key] = (digest, rendered_fingerprint(message))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self.stats["remembered"] += 1
+
+    def observe(self, key, message):
+        """Drop the entry if the message no longer looks like what we rendered"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] != rendered_fingerprint(message):
+                del self._entries[key]
+                self.stats["invalidated"] += 1
+
+    @contextmanager
+    def observed(self, key):
+        """Allow skips for key, a message observed for this callback, inside the block"""
+        previous = getattr(self._observed, "key", None)
+        self._observed.key = key
+        try:
+            yield
+        finally:
+            self._observed.key = previous
+
+    def forget(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "capacity": self.capacity}
+
+render_memo = RenderMemo(RENDER_MEMO_SIZE)
+
 # -------------------------
 # Utilities
 # -------------------------
@@ -233,27 +2151,33 @@ def make_base_filename(subject: str) -> str:
     return subject.replace(" ", "_").replace("-", "").replace("/", "")
 
 def send_message(chat_id, text, reply_markup=None):
-    """Send message using requests"""
-    url = f"https://api.telegram.org/bot{TOKEN}/sendMessage"
+    """Send message"""
     data = {"chat_id": chat_id, "text": text, "parse_mode": "Markdown"}
     if reply_markup:
-        data["reply_markup"] = json.dumps(reply_markup)
+        data["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
     try:
-        response = requests.post(url, json=data, timeout=10)
-        return response.json()
+        response_data = telegram.call("sendMessage", data)
+        if response_data.get('ok'):
+            message = response_data['result']
+            render_memo.remember((chat_id, message['message_id']), render_digest(text, data.get("reply_markup")), message)
+        return response_data
     except Exception as e:
-        print(f"❌ Error sending message: {e}")
+        log.error("❌ Error sending message: %s", e)
         return None
 
 def edit_message(chat_id, message_id, text, reply_markup=None):
-    """Edit message using requests"""
-    url = f"https://api.telegram.org/bot{TOKEN}/editMessageText"
+    """Edit message"""
     data = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "Markdown"}
     if reply_markup:
-        data["reply_markup"] = json.dumps(reply_markup)
+        data["reply_markup"] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
+    
+    key = (chat_id, message_id)
+    digest = render_digest(text, data.get("reply_markup"))
+    if render_memo.is_current(key, digest):
+        edits_skipped_total.inc()
+        return {"ok": True}
     try:
-        response = requests.post(url, json=data, timeout=10)
-        response_data = response.json()
+        response_data = telegram.call("editMessageText", data)
         
         if not response_data.get('ok'):
             error_code = response_data.get('error_code')
@@ -262,62 +2186,142 @@ def edit_message(chat_id, message_id, text, reply_markup=None):
             if error_code == 400 and "message is not modified" in error_description:
                 return {"ok": True}
             
-            print(f"⚠️ Edit message failed: {response_data}")
+            render_memo.forget(key)
+            log.warning("⚠️ Edit message failed: %s", response_data)
             return None
         
+        render_memo.remember(key, digest, response_data.get('result'))
         return response_data
     except Exception as e:
-        print(f"❌ Error editing message: {e}")
+        log.error("❌ Error editing message: %s", e)
+        return None
+
+def delete_message(chat_id, message_id):
+    """Delete message"""
+    render_memo.forget((chat_id, message_id))
+    try:
+        return telegram.call("deleteMessage", {"chat_id": chat_id, "message_id": message_id})
+    except Exception as e:
+        log.error("❌ Error deleting message: %s", e)
         return None
 
 def send_document(chat_id, file_path, caption=None):
-    """Send document using requests"""
-    url = f"https://api.telegram.org/bot{TOKEN}/sendDocument"
+    """Send document, reusing Telegram's file_id when the file was uploaded before"""
     data = {"chat_id": chat_id}
     if caption:
         data["caption"] = caption
     try:
+        signature = get_file_signature(file_path)
+        file_id = get_cached_file_id(file_path, signature)
+        
+        if file_id:
+            response_data = telegram.call("sendDocument", {**data, "document": file_id}, timeout=10)
+            if response_data.get('ok') or response_data.get('error_code') != 400:
+                return response_data
+            # Telegram no longer accepts this file_id; upload the bytes again
+            log.warning("⚠️ Stale file_id for %s: %s", file_path, response_data.get('description'))
+            invalidate_file_id(file_path)
+        
         with open(file_path, "rb") as doc:
-            files = {"document": doc}
-            response = requests.post(url, data=data, files=files, timeout=60)
-        return response.json()
+            response_data = telegram.call("sendDocument", data, files={"document": doc})
+        document_bytes_total.inc(amount=signature[0])
+        
+        if response_data.get('ok'):
+            document = response_data['result'].get('document')
+            if document:
+                store_file_id(file_path, signature, document['file_id'])
+        return response_data
+    except Exception as e:
+        log.error("❌ Error sending document: %s", e)
+        return None
+
+def send_media_group(chat_id, documents):
+    """Send several PDFs as one album; documents is a list of (path, caption)"""
+    try:
+        signatures = [get_file_signature(path) for path, _ in documents]
+        file_ids = [get_cached_file_id(path, sig) for (path, _), sig in zip(documents, signatures)]
+        
+        for attempt in range(2):
+            media = []
+            files = {}
+            for i, ((path, caption), file_id) in enumerate(zip(documents, file_ids)):
+                item = {"type": "document", "caption": caption}
+                if file_id:
+                    item["media"] = file_id
+                else:
+                    item["media"] = f"attach://doc{i}"
+                    files[f"doc{i}"] = open(path, "rb")
+                    document_bytes_total.inc(amount=signatures[i][0])
+                media.append(item)
+            
+            data = {"chat_id": chat_id, "media": json.dumps(media)}
+            try:
+                if files:
+                    response_data = telegram.call("sendMediaGroup", data, files=files)
+                else:
+                    response_data = telegram.call("sendMediaGroup", data, timeout=10)
+            finally:
+                for f in files.values():
+                    f.close()
+            
+            if response_data.get('ok'):
+                for (path, _), sig, file_id, message in zip(documents, signatures, file_ids, response_data['result']):
+                    document = message.get('document')
+                    if document and not file_id:
+                        store_file_id(path, sig, document['file_id'])
+                return response_data
+            
+            if attempt or response_data.get('error_code') != 400 or not any(file_ids):
+                return response_data
+            # A cached file_id was rejected; drop them all and upload the bytes
+            log.warning("⚠️ Stale file_id in media group: %s", response_data.get('description'))
+            for (path, _), file_id in zip(documents, file_ids):
+                if file_id:
+                    invalidate_file_id(path)
+            file_ids = [None] * len(documents)
     except Exception as e:
-        print(f"❌ Error sending document: {e}")
+        log.error("❌ Error sending media group: %s", e)
         return None
 
+def is_document_cached(file_path):
+    """True when the file can be sent by file_id without uploading"""
+    try:
+        return get_cached_file_id(file_path, get_file_signature(file_path)) is not None
+    except OSError:
+        return False
+
 def answer_callback_query(callback_query_id, text=None):
     """Answer callback query"""
-    url = f"https://api.telegram.org/bot{TOKEN}/answerCallbackQuery"
     data = {"callback_query_id": callback_query_id}
     if text:
         data["text"] = text
         data["show_alert"] = True
     try:
-        response = requests.post(url, json=data, timeout=5)
-        return response.json()
+        return telegram.call("answerCallbackQuery", data)
     except Exception as e:
-        print(f"❌ Error answering callback: {e}")
+        log.error("❌ Error answering callback: %s", e)
         return None
 
+_bot_username = os.getenv("BOT_USERNAME")
+
 def get_bot_username():
-    """Get bot username"""
+    """Bot username, resolved with getMe once and then cached"""
+    return _bot_username or "BPharmabot"
+
+def resolve_bot_username():
+    """Look up the bot username with getMe and cache it"""
+    global _bot_username
     try:
-        url = f"https://api.telegram.org/bot{TOKEN}/getMe"
-        response = requests.get(url, timeout=5)
-        data = response.json()
+        data = telegram.call("getMe")
         if data.get('ok'):
-            username = data['result']['username']
-            print(f"🤖 Bot username: {username}")
-            return username
-        return "BPharmabot"
-    except:
-        return "BPharmabot"
-
-def create_razorpay_payment_link(amount, semester, user_id, chat_id):
+            _bot_username = data['result']['username']
+            log.info("🤖 Bot username: %s", _bot_username)
+    except Exception as e:
+        log.error("❌ Error getting bot username: %s", e)
+    return get_bot_username()
+
+def create_razorpay_payment_link(amount, semester, user_id, chat_id, expire_by=None):
     """Create Razorpay payment link"""
-    url = "https://api.razorpay.com/v1/payment_links"
-    auth = (RAZORPAY_KEY_ID, RAZORPAY_KEY_SECRET)
-    
     callback_url = f"{RENDER_URL}{PAYMENT_SUCCESS_PATH}?user_id={user_id}&semester={semester}&chat_id={chat_id}"
     
     payload = {
@@ -332,12 +2336,16 @@ def create_razorpay_payment_link(amount, semester, user_id, chat_id):
             "chat_id": str(chat_id)
         }
     }
+    if expire_by:
+        payload["expire_by"] = expire_by
     
     try:
-        response = requests.post(url, json=payload, auth=auth, timeout=10)
+        response = razorpay.request(
+            "POST", "/payment_links", json=payload, histogram=razorpay_seconds, label="create_payment_link"
+        )
         return response.json()
     except Exception as e:
-        print(f"❌ Error creating payment link: {e}")
+        log.error("❌ Error creating payment link: %s", e)
         return None
 
 def verify_razorpay_signature(payload, signature, secret):
@@ -349,14 +2357,384 @@ def verify_razorpay_signature(payload, signature, secret):
     ).hexdigest()
     return hmac.compare_digest(expected_signature, signature)
 
+# -------------------------
+# Payment Reconciliation
+# -------------------------
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "300"))
+# Reused links stay payable until they expire, so passes must reach back at
+# least PAYMENT_LINK_TTL; smaller values are raised to it
+RECONCILE_LOOKBACK = int(os.getenv("RECONCILE_LOOKBACK", str(PAYMENT_LINK_TTL + 3600)))
+RECONCILE_PAGE_SIZE = int(os.getenv("RECONCILE_PAGE_SIZE", "100"))
+RECONCILE_MAX_PAGES = int(os.getenv("RECONCILE_MAX_PAGES", "20"))
+# Minimum seconds between on-demand checks triggered by one user
+RECONCILE_USER_INTERVAL = int(os.getenv("RECONCILE_USER_INTERVAL", "30"))
+# pg advisory lock key held for the length of a pass, shared by all workers
+RECONCILE_LOCK_KEY = 0x7265636F6E63696C
+
+class PaymentReconciler:
+    """Unlocks paid payment links whose webhook and redirect never arrived.
+
+    A pass pages through recent links with Razorpay's list API, keeps the
+    paid ones whose notes carry user_id and semester, and writes them with
+    a single mark_semesters_paid. Every worker runs the interval loop, but
+    a pass first takes an advisory lock and the job_runs lease in one
+    transaction held until it ends. So only one worker runs a pass at a
+    time, at most once per RECONCILE_INTERVAL. When a user taps "I've
+    Completed Payment", only their stored link is fetched.
+    """
+
+    def __init__(self, interval, lookback, page_size, max_pages, user_interval):
+        self.interval = interval
+        self.lookback = max(lookback, PAYMENT_LINK_TTL)
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.user_interval = user_interval
+        self.enabled = bool(RAZORPAY_KEY_ID and DATABASE_URL)
+        self._flight = SingleFlight()
+        self._user_checks = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {
+            "runs": 0, "skipped": 0, "pages": 0, "paid_links": 0, "unlocked": 0,
+            "errors": 0, "user_checks": 0, "rate_limited": 0, "last_run": None,
+        }
+
+    def ensure_started(self):
+        if not self.enabled or not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="payment-reconciler", daemon=True).start()
+            log.info("🧾 Reconciling payment links every %ss", self.interval)
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.run()
+
+    def run(self):
+        """One pass; returns the (user_id, semester) pairs it unlocked"""
+        if not self.enabled:
+            return []
+        return self._flight.do("reconcile", self._reconcile)
+
+    def check_user(self, user_id, semester):
+        """Fetch the user's stored link for semester and unlock it if paid.
+
+        False if they asked too recently, have no link, or Razorpay failed.
+        """
+        if not self.enabled:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._user_checks.get(user_id)
+            if last is not None and now - last < self.user_interval:
+                self.stats["rate_limited"] += 1
+                return False
+            self._user_checks[user_id] = now
+            self._user_checks.move_to_end(user_id)
+            while len(self._user_checks) > 10000:
+                self._user_checks.popitem(last=False)
+            self.stats["user_checks"] += 1
+
+        link = _load_payment_link(user_id, semester)
+        if not link:
+            return False
+        try:
+            response = razorpay.request(
+                "GET", f"/payment_links/{link['id']}", histogram=razorpay_seconds, label="fetch_payment_link"
+            )
+            response.raise_for_status()
+            status = response.json().get("status")
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.error("❌ Error fetching payment link %s: %s", link["id"], e)
+            return False
+        if status == "paid":
+            self.stats["paid_links"] += 1
+            if mark_semesters_paid([(user_id, semester)]):
+                self.stats["unlocked"] += 1
+                payment_log.info("🧾 Payment link %s was paid without a webhook", link["id"])
+        return True
+
+    def _reconcile(self):
+        try:
+            with db_cursor() as cursor:
+                if cursor is None:
+                    return []
+                cursor.execute("SELECT pg_try_advisory_xact_lock(%s)", (RECONCILE_LOCK_KEY,))
+                locked = cursor.fetchone()[0]
+                if locked:
+                    # Workers wake at different times; the first each interval runs the pass
+                    cursor.execute(
+                        """INSERT INTO job_runs (name, last_run) VALUES (%s, NOW())
+                           ON CONFLICT (name) DO UPDATE SET last_run = NOW()
+                           WHERE job_runs.last_run < NOW() - make_interval(secs => %s)""",
+                        ("payment_reconcile", self.interval * 0.9)
+                    )
+                    locked = cursor.rowcount == 1
+                if not locked:
+                    self.stats["skipped"] += 1
+                    return []
+                # Both are released when this transaction commits after the pass
+                return self._reconcile_pass()
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.error("❌ Error starting reconciliation: %s", e)
+            return []
+
+    def _reconcile_pass(self):
+        try:
+            links = self.fetch_paid_links(int(time.time()) - self.lookback)
+        except Exception as e:
+            self.stats["errors"] += 1
+            log.error("❌ Error listing payment links: %s", e)
+            return []
+
+        chats = {}
+        for notes in links:
+            try:
+                user_id = int(notes["user_id"])
+                chats[(user_id, notes["semester"])] = int(notes.get("chat_id") or user_id)
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        unlocked = mark_semesters_paid(chats) if chats else []
+        for user_id, semester in unlocked:
+            run_async(send_message, chats[(user_id, semester)], f"✅ *Payment Confirmed!*\n\n🎉 *{semester} Unlocked!*")
+        self.stats["runs"] += 1
+        self.stats["paid_links"] += len(links)
+        self.stats["unlocked"] += len(unlocked)
+        self.stats["last_run"] = time.time()
+        if unlocked:
+            payment_log.info("🧾 Reconciliation unlocked %s semesters missed by webhooks", len(unlocked))
+        return unlocked
+
+    def fetch_paid_links(self, since):
+        """Notes of paid links created after since, newest first"""
+        paid = []
+        for page in range(self.max_pages):
+            response = razorpay.request(
+                "GET", "/payment_links", params={"count": self.page_size, "skip": page * self.page_size},
+                histogram=razorpay_seconds, label="list_payment_links",
+            )
+            response.raise_for_status()
+            links = response.json().get("payment_links", [])
+            self.stats["pages"] += 1
+            for link in links:
+                if link.get("status") == "paid" and link.get("created_at", since) >= since:
+                    paid.append(link.get("notes") or {})
+            if len(links) < self.page_size or any(link.get("created_at", since) < since for link in links):
+                break
+        return paid
+
+    def get_stats(self):
+        return {**self.stats, "enabled": self.enabled, "interval": self.interval}
+
+payment_reconciler = PaymentReconciler(
+    RECONCILE_INTERVAL, RECONCILE_LOOKBACK, RECONCILE_PAGE_SIZE, RECONCILE_MAX_PAGES, RECONCILE_USER_INTERVAL
+)
+
+# -------------------------
+# Content Catalog
+# -------------------------
+FEEDBACK_URL = "https://codecrafter02.github.io/Feedback02/"
+
+def _scan_folder(folder_path):
+    """Map PDF filename -> stat result for one semester folder"""
+    files = {}
+    try:
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".pdf"):
+                    files[entry.name] = entry.stat()
+    except FileNotFoundError:
+        pass
+    return files
+
+# Written by optimize_pdfs.py: relative path -> source_sha256 the copy was made from
+OPTIMIZED_MANIFEST = os.path.join(OPTIMIZED_FOLDER, "manifest.json")
+# path -> (size, mtime_ns, sha256), so reloads only rehash changed files
+_source_hashes = {}
+
+def _load_optimized_manifest():
+    try:
+        with open(OPTIMIZED_MANIFEST) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log.error("❌ Error reading %s, serving originals: %s", OPTIMIZED_MANIFEST, e)
+        return {}
+
+def _source_sha256(path, stat):
+    cached = _source_hashes.get(path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    _source_hashes[path] = (stat.st_size, stat.st_mtime_ns, digest.hexdigest())
+    return digest.hexdigest()
+
+def _file_entry(folder_path, filename, available_files, optimized_folder, optimized_files, manifest):
+    source = available_files.get(filename)
+    optimized = optimized_files.get(filename)
+    source_path = os.path.join(folder_path, filename)
+    # Same rule as optimize_pdfs.py: a copy is current while the source hash
+    # it was made from matches, whatever the file times say after a deploy
+    made_from = manifest.get(os.path.relpath(source_path, PAPER_FOLDER), {}).get("source_sha256")
+    if source is not None and optimized is not None and made_from == _source_sha256(source_path, source):
+        return {
+            "path": os.path.join(optimized_folder, filename),
+            "available": True,
+            "size": optimized.st_size,
+            "optimized": True,
+        }
+    return {
+        "path": os.path.join(folder_path, filename),
+        "available": source is not None,
+        "size": source.st_size if source is not None else 0,
+        "optimized": False,
+    }
+
+def build_catalog():
+    """Scan PAPER_FOLDER once and precompute everything handlers look up"""
+    semester_keyboard = [[{"text": sem, "callback_data": sem}] for sem in semesters.keys()]
+    semester_keyboard.append([{"text": "📩 Feedback", "url": FEEDBACK_URL}])
+
+    catalog = {
+        "subjects": {},
+        "semesters": {},
+        "semester_keyboard": json.dumps({"inline_keyboard": semester_keyboard}),
+        "nav_keyboard": json.dumps({"inline_keyboard": [
+            [{"text": "⬅ Back to Subjects", "callback_data": "BACK_SUBJECTS"}],
+            [{"text": "🔙 Back to Semesters", "callback_data": "BACK_SEMESTERS"}],
+        ]}),
+        "built_at": time.time(),
+    }
+
+    manifest = _load_optimized_manifest()
+    for semester, subjects in semesters.items():
+        folder_path = os.path.join(PAPER_FOLDER, semester.replace(" ", "_"))
+        available_files = _scan_folder(folder_path)
+        optimized_folder = os.path.join(OPTIMIZED_FOLDER, semester.replace(" ", "_"))
+        optimized_files = _scan_folder(optimized_folder)
+
+        keyboard = [[{"text": subject, "callback_data": subject}] for subject in subjects]
+        keyboard.append([{"text": "🔙 Back to Semesters", "callback_data": "BACK_SEMESTERS"}])
+        catalog["semesters"][semester] = {
+            "folder": folder_path,
+            "subjects": list(subjects),
+            "subject_keyboard": json.dumps({"inline_keyboard": keyboard}),
+        }
+
+        for subject in subjects:
+            if subject in catalog["subjects"]:
+                log.warning("⚠️ Subject listed in two semesters, keeping first: %s", subject)
+                continue
+            base = make_base_filename(subject)
+            catalog["subjects"][subject] = {
+                "semester": semester,
+                "prev": _file_entry(
+                    folder_path, f"{base}.pdf", available_files, optimized_folder, optimized_files, manifest
+                ),
+                "guess": _file_entry(
+                    folder_path, f"{base}_Guess.pdf", available_files, optimized_folder, optimized_files, manifest
+                ),
+            }
+
+    return catalog
+
+def reload_catalog():
+    """Rebuild the catalog, e.g. after PDFs were added to PAPER_FOLDER"""
+    global catalog
+    catalog = build_catalog()
+    stats = get_catalog_stats()
+    log.info("📚 Catalog loaded: %s subjects, %s files", stats['subjects'], stats['files_available'])
+    return stats
+
+def get_catalog_stats():
+    files = [entry[kind] for entry in catalog["subjects"].values() for kind in ("prev", "guess")]
+    available = [f for f in files if f["available"]]
+    return {
+        "subjects": len(catalog["subjects"]),
+        "files_available": len(available),
+        "files_missing": len(files) - len(available),
+        "files_optimized": sum(1 for f in available if f["optimized"]),
+        "bytes_available": sum(f["size"] for f in available),
+        "built_at": catalog["built_at"],
+    }
+
+catalog = build_catalog()
+
+# -------------------------
+# Signed Downloads
+# -------------------------
+DOWNLOAD_TTL = int(os.getenv("DOWNLOAD_TTL", "3600"))
+# Shared by all workers; derived from the bot token unless set explicitly
+_download_key = (
+    os.getenv("DOWNLOAD_SECRET")
+    or hmac.new((TOKEN or "").encode(), b"download-links", hashlib.sha256).hexdigest()
+).encode()
+
+def _sign_download(payload):
+    return hmac.new(_download_key, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+def make_download_token(user_id, semester, subject, kind):
+    """Token granting one user one catalog file until it expires.
+
+    Expiry is rounded up to a DOWNLOAD_TTL boundary (so a link lives between
+    one and two TTLs). Repeat taps in the same window get the same URL, and
+    browsers and the CDN can reuse what they already downloaded.
+    """
+    expires = (int(time.time()) // DOWNLOAD_TTL + 2) * DOWNLOAD_TTL
+    claims = json.dumps([user_id, semester, subject, kind, expires], separators=(",", ":"))
+    payload = base64.urlsafe_b64encode(claims.encode()).decode().rstrip("=")
+    return f"{payload}.{_sign_download(payload)}"
+
+def read_download_token(token):
+    """Claims dict for a valid token, "expired", or None if it is forged or malformed"""
+    if not token.isascii():
+        # compare_digest only accepts ASCII strings
+        return None
+    payload, _, signature = token.partition(".")
+    if not hmac.compare_digest(_sign_download(payload), signature):
+        return None
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        user_id, semester, subject, kind, expires = claims
+    except (ValueError, TypeError):
+        return None
+    if expires < time.time():
+        return "expired"
+    return {"user_id": user_id, "semester": semester, "subject": subject, "kind": kind, "expires": expires}
+
+def download_url(user_id, semester, subject, kind):
+    return f"{RENDER_URL}{DOWNLOAD_PATH}/{make_download_token(user_id, semester, subject, kind)}"
+
+def send_download_links(chat_id, user_id, subject, entry):
+    """One message with a download button per available file"""
+    buttons = []
+    for kind, label in (("prev", "📄 Previous Year"), ("guess", "📝 Guess Paper")):
+        if entry[kind]["available"]:
+            url = download_url(user_id, entry["semester"], subject, kind)
+            buttons.append([{"text": f"⬇️ {label}", "url": url}])
+    if buttons:
+        text = f"📥 *{subject}*\n\nTap to download. Links stay valid for at least {DOWNLOAD_TTL // 60} minutes."
+        send_message(chat_id, text, json.dumps({"inline_keyboard": buttons}))
+
 # -------------------------
 # Handlers
 # -------------------------
+@timed(handler_seconds, "handler")
 def handle_start(chat_id):
     """Handle /start command"""
-    keyboard = [[{"text": sem, "callback_data": sem}] for sem in semesters.keys()]
-    keyboard.append([{"text": "📩 Feedback", "url": "https://codecrafter02.github.io/Feedback02/"}])
-    reply_markup = {"inline_keyboard": keyboard}
+    event_log.record("start", chat_id)
+    reply_markup = catalog["semester_keyboard"]
     
     welcome_text = (
         "🎓 *Welcome to B.Pharm Study Material Bot!*\n\n"
@@ -370,8 +2748,10 @@ def handle_start(chat_id):
     
     return send_message(chat_id, welcome_text, reply_markup)
 
+@timed(handler_seconds, "handler")
 def handle_semester_selection(chat_id, message_id, user_id, semester):
     """Handle semester selection"""
+    event_log.record("semester_view", user_id, semester)
     save_user_session(user_id, semester, message_id)
     
     if is_semester_paid(user_id, semester):
@@ -379,9 +2759,11 @@ def handle_semester_selection(chat_id, message_id, user_id, semester):
     else:
         show_payment_screen(chat_id, message_id, user_id, semester)
 
+@timed(handler_seconds, "handler")
 def show_payment_screen(chat_id, message_id, user_id, semester):
     """Show payment screen"""
-    payment_link_data = create_razorpay_payment_link(10, semester, user_id, chat_id)
+    event_log.record("paywall_view", user_id, semester)
+    payment_link_data = get_payment_link(10, semester, user_id, chat_id)
     
     if not payment_link_data or "short_url" not in payment_link_data:
         send_message(chat_id, "❌ Error creating payment link. Please try again later.")
@@ -411,12 +2793,10 @@ def show_payment_screen(chat_id, message_id, user_id, semester):
         if new_result and new_result.get('ok'):
             save_user_session(user_id, semester, new_result['result']['message_id'])
 
+@timed(handler_seconds, "handler")
 def show_subjects(chat_id, message_id, user_id, semester):
     """Show subjects"""
-    subjects = semesters[semester]
-    keyboard = [[{"text": subject, "callback_data": subject}] for subject in subjects]
-    keyboard.append([{"text": "🔙 Back to Semesters", "callback_data": "BACK_SEMESTERS"}])
-    reply_markup = {"inline_keyboard": keyboard}
+    reply_markup = catalog["semesters"][semester]["subject_keyboard"]
     
     text = f"📘 *{semester}*\n✅ Unlocked\n\nSelect a subject:"
     
@@ -427,65 +2807,75 @@ def show_subjects(chat_id, message_id, user_id, semester):
         if new_result and new_result.get('ok'):
             save_user_session(user_id, semester, new_result['result']['message_id'])
 
+@timed(handler_seconds, "handler")
 def handle_subject_selection(chat_id, message_id, user_id, subject):
     """Handle subject selection"""
-    user_info = get_user_session(user_id)
-    semester = user_info.get("semester")
-    
-    if not semester:
-        send_message(chat_id, "❗Please select a semester first using /start")
-        return
+    entry = catalog["subjects"][subject]
+    semester = entry["semester"]
 
     if not is_semester_paid(user_id, semester):
         answer_callback_query(message_id, "❌ Please pay to unlock this semester first!")
         return
 
-    edit_message(chat_id, message_id, f"✅ Selected: *{subject}*", None)
-    loading_msg = send_message(chat_id, f"📂 Loading files for: *{subject}*...")
+    documents = []
+    if entry["prev"]["available"]:
+        documents.append((entry["prev"]["path"], f"📄 Previous Year • {subject}"))
+    if entry["guess"]["available"]:
+        documents.append((entry["guess"]["path"], f"📝 Guess Paper • {subject}"))
 
-    base = make_base_filename(subject)
-    folder = semester.replace(" ", "_")
-    prev_path = os.path.join(PAPER_FOLDER, folder, f"{base}.pdf")
-    guess_path = os.path.join(PAPER_FOLDER, folder, f"{base}_Guess.pdf")
+    event_log.record("download", user_id, semester, subject)
 
-    if os.path.exists(prev_path):
-        send_document(chat_id, prev_path, f"📄 Previous Year • {subject}")
-    else:
+    # The edit of the tapped message doesn't need to finish before the files go out
+    edit_future = run_async(edit_message, chat_id, message_id, f"✅ Selected: *{subject}*", None)
+
+    # Cached files go out by file_id almost instantly, so skip the loading message
+    loading_msg = None
+    if DOCUMENT_DELIVERY != "link" and not all(is_document_cached(path) for path, _ in documents):
+        loading_msg = send_message(chat_id, f"📂 Loading files for: *{subject}*...")
+
+    if not entry["prev"]["available"]:
         send_message(chat_id, f"❌ Previous year file not found for {subject}!")
+    if not entry["guess"]["available"]:
+        send_message(chat_id, f"❌ Guess paper not found for {subject}!")
 
-    if os.path.exists(guess_path):
-        send_document(chat_id, guess_path, f"📝 Guess Paper • {subject}")
+    if DOCUMENT_DELIVERY == "link":
+        send_download_links(chat_id, user_id, subject, entry)
+    elif DOCUMENT_DELIVERY == "media_group" and len(documents) > 1:
+        send_media_group(chat_id, documents)
     else:
-        send_message(chat_id, f"❌ Guess paper not found for {subject}!")
+        for path, caption in documents:
+            send_document(chat_id, path, caption)
 
-    keyboard = [
-        [{"text": "⬅ Back to Subjects", "callback_data": "BACK_SUBJECTS"}],
-        [{"text": "🔙 Back to Semesters", "callback_data": "BACK_SEMESTERS"}],
-    ]
+    delete_future = None
+    if loading_msg and loading_msg.get('ok'):
+        delete_future = run_async(delete_message, chat_id, loading_msg['result']['message_id'])
     
     nav_text = f"📂 Files sent for: *{subject}*\n\nChoose next action:"
-    nav_result = send_message(chat_id, nav_text, {"inline_keyboard": keyboard})
+    nav_result = send_message(chat_id, nav_text, catalog["nav_keyboard"])
     
     if nav_result and nav_result.get('ok'):
         save_user_session(user_id, semester, nav_result['result']['message_id'])
 
-    if loading_msg and loading_msg.get('ok'):
-        try:
-            delete_url = f"https://api.telegram.org/bot{TOKEN}/deleteMessage"
-            requests.post(delete_url, json={"chat_id": chat_id, "message_id": loading_msg['result']['message_id']}, timeout=5)
-        except:
-            pass
+    edit_future.result()
+    if delete_future:
+        delete_future.result()
 
+@timed(handler_seconds, "handler")
 def handle_check_payment(chat_id, message_id, user_id, semester, callback_query_id):
     """Check payment"""
-    print(f"🔍 Checking payment: user={user_id}, semester={semester}")
+    payment_log.info("🔍 Checking payment: user=%s, semester=%s", user_id, semester)
     
-    if is_semester_paid(user_id, semester):
+    # If the webhook was lost, ask Razorpay directly before giving up
+    paid = is_semester_paid(user_id, semester) or (
+        payment_reconciler.check_user(user_id, semester) and is_semester_paid(user_id, semester)
+    )
+    if paid:
         answer_callback_query(callback_query_id, "✅ Payment verified!")
         show_subjects(chat_id, message_id, user_id, semester)
     else:
         answer_callback_query(callback_query_id, "❌ Payment not confirmed yet. Please complete payment or wait a moment.")
 
+@timed(handler_seconds, "handler")
 def handle_back_to_subjects(chat_id, message_id, user_id):
     """Back to subjects"""
     info = get_user_session(user_id)
@@ -501,11 +2891,10 @@ def handle_back_to_subjects(chat_id, message_id, user_id):
 
     show_subjects(chat_id, message_id, user_id, semester)
 
+@timed(handler_seconds, "handler")
 def handle_back_to_semesters(chat_id, message_id, user_id):
     """Back to semesters"""
-    keyboard = [[{"text": sem, "callback_data": sem}] for sem in semesters.keys()]
-    keyboard.append([{"text": "📩 Feedback", "url": "https://codecrafter02.github.io/Feedback02/"}])
-    reply_markup = {"inline_keyboard": keyboard}
+    reply_markup = catalog["semester_keyboard"]
     
     info = get_user_session(user_id)
     nav_message_id = info.get("nav_message_id", message_id)
@@ -518,40 +2907,480 @@ def handle_back_to_semesters(chat_id, message_id, user_id):
             save_user_session(user_id, info.get("semester"), new_result['result']['message_id'])
 
 # -------------------------
-# Flask Routes
+# Update Dispatch
 # -------------------------
-@app.route("/")
-def home():
-    return "✅ Bot is Live!", 200
+def is_valid_update(data):
+    """Check that a webhook body looks like a Telegram update we handle"""
+    if not isinstance(data, dict) or "update_id" not in data:
+        return False
+    return "message" in data or "callback_query" in data
 
-@app.route(PAYMENT_SUCCESS_PATH, methods=["GET"])
-def payment_success():
-    """Payment success page"""
-    user_id = request.args.get('user_id')
-    semester = request.args.get('semester')
-    chat_id = request.args.get('chat_id')
-    
-    print(f"💰 Payment success: user={user_id}, semester={semester}, chat={chat_id}")
-    
-    bot_username = get_bot_username()
-    
-    if user_id and semester and chat_id:
+class UserLanes:
+    """Runs one user's updates one at a time, in arrival order.
+
+    The first update for an idle user runs on the calling thread, which
+    then also runs whatever queued up for that user in the meantime. Later
+    updates only join that queue and return, so no thread ever sits waiting
+    for another user's lane and taps cannot race on the session row or the
+    nav message. An update whose key (the callback data) is already queued
+    or running for that user is dropped instead of running twice.
+    """
+
+    class _Lane:
+        __slots__ = ("pending", "keys")
+
+        def __init__(self):
+            self.pending = deque()
+            self.keys = set()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._stats = {"ran": 0, "queued": 0, "coalesced": 0}
+
+    def run(self, user_id, key, fn, *args):
+        """Run or queue fn(*args) in the user's lane; False if it was coalesced"""
+        with self._lock:
+            lane = self._lanes.get(user_id)
+            if lane is not None:
+                if key in lane.keys:
+                    self._stats["coalesced"] += 1
+                    return False
+                lane.keys.add(key)
+                # Carry the log context over to whichever thread runs it
+                lane.pending.append((key, fn, args, get_log_context()))
+                self._stats["queued"] += 1
+                return True
+            lane = self._lanes[user_id] = self._Lane()
+            lane.keys.add(key)
+
+        item = (key, fn, args, None)
+        while item is not None:
+            key, fn, args, context = item
+            try:
+                if context is None:
+                    fn(*args)
+                else:
+                    with log_context(**context):
+                        fn(*args)
+            except Exception as e:
+                log.exception("❌ Error in user lane: %s", e)
+            with self._lock:
+                lane.keys.discard(key)
+                self._stats["ran"] += 1
+                if lane.pending:
+                    item = lane.pending.popleft()
+                else:
+                    del self._lanes[user_id]
+                    item = None
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            return {**self._stats, "active_users": len(self._lanes)}
+
+user_lanes = UserLanes()
+
+def process_update(data):
+    """Route a Telegram update to its handler"""
+    with log_context(update_id=data.get("update_id")):
         try:
-            user_id = int(user_id)
-            chat_id = int(chat_id)
-            
-            if mark_semester_paid(user_id, semester):
-                success_text = (
-                    f"✅ *Payment Successful!*\n\n"
-                    f"🎉 *{semester} Unlocked!*\n\n"
-                    f"📱 Return to Telegram and click 'I've Completed Payment' button."
+            _route_update(data)
+        except Exception as e:
+            log.exception("❌ Error processing update: %s", e)
+
+def _route_update(data):
+    if "message" in data:
+        message = data["message"]
+        chat_id = message["chat"]["id"]
+        user_id = message.get("from", {}).get("id", chat_id)
+
+        if "text" in message and str(message["text"]).startswith("/start"):
+            with log_context(user_id=user_id):
+                update_log.info("🚀 Start: %s", chat_id, extra=SAMPLED)
+                if not user_lanes.run(user_id, ("message", "/start"), handle_start, chat_id):
+                    update_log.info("🔁 Repeated /start coalesced")
+
+    elif "callback_query" in data:
+        cq = data["callback_query"]
+        cq_id = cq["id"]
+        chat_id = cq["message"]["chat"]["id"]
+        msg_id = cq["message"]["message_id"]
+        user_id = cq["from"]["id"]
+        cb_data = cq["data"]
+
+        with log_context(user_id=user_id):
+            update_log.info("🔔 Callback: %s, user: %s", cb_data, user_id, extra=SAMPLED)
+            render_memo.observe((chat_id, msg_id), cq["message"])
+
+            # Acknowledge every tap, including ones coalesced below, so the button stops spinning
+            answer_callback_query(cq_id)
+
+            args = (chat_id, msg_id, user_id, cb_data, cq_id)
+            if not user_lanes.run(user_id, ("callback", cb_data), _route_callback, *args):
+                update_log.info("🔁 Repeated tap on %s coalesced", cb_data)
+
+def _route_callback(chat_id, msg_id, user_id, cb_data, cq_id):
+    with user_state(user_id), render_memo.observed((chat_id, msg_id)):
+        if cb_data in semesters:
+            handle_semester_selection(chat_id, msg_id, user_id, cb_data)
+        elif cb_data.startswith("CHECK_PAYMENT_"):
+            semester = cb_data.replace("CHECK_PAYMENT_", "")
+            handle_check_payment(chat_id, msg_id, user_id, semester, cq_id)
+        elif cb_data == "BACK_SUBJECTS":
+            handle_back_to_subjects(chat_id, msg_id, user_id)
+        elif cb_data == "BACK_SEMESTERS":
+            handle_back_to_semesters(chat_id, msg_id, user_id)
+        elif cb_data in catalog["subjects"]:
+            handle_subject_selection(chat_id, msg_id, user_id, cb_data)
+
+class UpdateDeduplicator:
+    """Remembers recently seen update_ids so redeliveries are skipped.
+
+    The in-memory window covers redeliveries to the same worker. With
+    UPDATE_DEDUP_DB enabled, the processed_updates table is the shared
+    record, so a redelivery that lands on another worker is also caught.
+    """
+
+    def __init__(self, window, max_entries, use_db):
+        self.window = window
+        self.max_entries = max_entries
+        self.use_db = use_db
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_inserts = 0
+        self.stats = {"checked": 0, "duplicates": 0}
+
+    def is_duplicate(self, update_id):
+        """Record update_id and return True if it was already seen"""
+        now = time.monotonic()
+        with self._lock:
+            self.stats["checked"] += 1
+            while self._seen:
+                oldest_id, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.window and len(self._seen) < self.max_entries:
+                    break
+                del self._seen[oldest_id]
+            if update_id in self._seen:
+                self.stats["duplicates"] += 1
+                return True
+            self._seen[update_id] = now
+
+        if self.use_db and not self._claim_in_db(update_id):
+            with self._lock:
+                self.stats["duplicates"] += 1
+            return True
+        return False
+
+    @timed(db_seconds, "db")
+    def _claim_in_db(self, update_id):
+        """Insert the update_id; False if another worker already did"""
+        try:
+            with db_cursor() as cursor:
+                if cursor is None:
+                    return True
+                
+                cursor.execute(
+                    "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING",
+                    (update_id,)
                 )
-                send_message(chat_id, success_text)
+                claimed = cursor.rowcount == 1
+                
+                self._db_inserts += 1
+                if self._db_inserts % 1000 == 0:
+                    cursor.execute(
+                        "DELETE FROM processed_updates WHERE seen_at < NOW() - make_interval(secs => %s)",
+                        (self.window,)
+                    )
+            return claimed
         except Exception as e:
-            print(f"❌ Error: {e}")
-            traceback.print_exc()
-    
-    return f"""
+            # Fail open: processing twice beats dropping an update
+            log.error("❌ Error recording update: %s", e)
+            return True
+
+    def forget(self, update_id):
+        """Drop a recorded update_id so its redelivery is processed"""
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if not self.use_db:
+            return
+        try:
+            with db_cursor() as cursor:
+                if cursor is not None:
+                    cursor.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+        except Exception as e:
+            log.error("❌ Error forgetting update %s: %s", update_id, e)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["tracked"] = len(self._seen)
+        return stats
+
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_WINDOW, UPDATE_DEDUP_SIZE, UPDATE_DEDUP_DB)
+
+class UpdateDispatcher:
+    """Bounded queue of updates drained by a pool of worker threads.
+
+    Workers are started lazily in the process that first submits, so each
+    gunicorn worker gets its own threads after the fork.
+    """
+
+    def __init__(self, handler, workers, max_queue):
+        self.handler = handler
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._accepting = True
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "processed": 0,
+            "max_wait_seconds": 0.0,
+            "last_wait_seconds": 0.0,
+        }
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"update-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+            log.info("🧵 Update dispatcher started: %s workers, queue=%s", self.workers, self.queue.maxsize)
+
+    def submit(self, update):
+        """Queue an update; returns False when the queue is full or draining"""
+        if not self._accepting:
+            return False
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            self._count("rejected")
+            return False
+        self._count("submitted")
+        return True
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                enqueued_at, update = item
+                wait = time.monotonic() - enqueued_at
+                with self._stats_lock:
+                    self.stats["last_wait_seconds"] = wait
+                    if wait > self.stats["max_wait_seconds"]:
+                        self.stats["max_wait_seconds"] = wait
+                self.handler(update)
+                self._count("processed")
+            finally:
+                self.queue.task_done()
+
+    def oldest_age(self):
+        """Seconds the oldest queued update has been waiting"""
+        with self.queue.mutex:
+            if not self.queue.queue or self.queue.queue[0] is None:
+                return 0.0
+            return time.monotonic() - self.queue.queue[0][0]
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["depth"] = self.queue.qsize()
+        stats["capacity"] = self.queue.maxsize
+        stats["oldest_age_seconds"] = self.oldest_age()
+        stats["workers"] = self.workers if self._pid == os.getpid() else 0
+        return stats
+
+    def shutdown(self, timeout=None):
+        """Stop accepting updates and let workers finish what is queued"""
+        if not self._accepting:
+            return
+        self._accepting = False
+        if self._pid != os.getpid():
+            return
+        timeout = WEBHOOK_DRAIN_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        log.info("⏳ Draining %s queued updates", self.queue.qsize())
+        for _ in self._threads:
+            # Sentinels go behind the queued updates, so workers drain first
+            while True:
+                try:
+                    self.queue.put(None, timeout=max(0.1, deadline - time.monotonic()))
+                    break
+                except queue.Full:
+                    if time.monotonic() >= deadline:
+                        break
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
+        log.info("✅ Dispatcher stopped, %s updates left unprocessed", self.queue.qsize())
+
+update_dispatcher = UpdateDispatcher(process_update, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+atexit.register(update_dispatcher.shutdown)
+
+# -------------------------
+# Long Polling
+# -------------------------
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "25"))
+POLL_LIMIT = int(os.getenv("POLL_LIMIT", "100"))
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "8"))
+UPDATE_OFFSET_KEY = "telegram_update_offset"
+
+def load_update_offset():
+    """Next update_id to request, or None to start from Telegram's oldest pending update"""
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return None
+            cursor.execute("SELECT value FROM bot_state WHERE key = %s", (UPDATE_OFFSET_KEY,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+    except Exception as e:
+        log.error("❌ Error loading update offset: %s", e)
+        return None
+
+def save_update_offset(offset):
+    try:
+        with db_cursor() as cursor:
+            if cursor is None:
+                return
+            cursor.execute('''
+                INSERT INTO bot_state (key, value) VALUES (%s, %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+            ''', (UPDATE_OFFSET_KEY, offset))
+    except Exception as e:
+        log.error("❌ Error saving update offset: %s", e)
+
+def update_chat_id(data):
+    if "message" in data:
+        return data["message"]["chat"]["id"]
+    return data["callback_query"].get("message", {}).get("chat", {}).get("id")
+
+class UpdatePoller:
+    """Pulls updates with getUpdates instead of receiving webhooks.
+
+    Each batch is split by chat: different chats are handled concurrently,
+    while one chat's updates run in the order Telegram sent them. The offset
+    is persisted only after the whole batch is handled, so a crash re-fetches
+    the batch. Each update is claimed with the deduplicator just before its
+    handler runs, so the re-fetch skips the updates that had started and
+    runs the rest. That needs claims that outlive the process, so polling
+    mode always records them in processed_updates; without DATABASE_URL a
+    re-fetched batch runs again in full. Run a single polling process per
+    bot token; Telegram rejects concurrent getUpdates.
+    """
+
+    def __init__(self, handler, workers, timeout, limit):
+        self.handler = handler
+        self.workers = workers
+        self.timeout = timeout
+        self.limit = limit
+        self._offset = None
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats = {"polls": 0, "batches": 0, "updates": 0, "largest_batch": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+
+    def start(self):
+        self._offset = load_update_offset()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="poll")
+        self._thread = threading.Thread(target=self._run, name="update-poller", daemon=True)
+        self._thread.start()
+        log.info("📥 Polling for updates from offset %s with %s workers", self._offset, self.workers)
+
+    def _count(self, key, amount=1):
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                updates = self.fetch()
+                backoff = 1
+            except Exception as e:
+                self._count("errors")
+                log.error("❌ getUpdates failed: %s, retrying in %ss", e, backoff)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+                continue
+
+            if updates:
+                self.process_batch(updates)
+                self._offset = updates[-1]["update_id"] + 1
+                save_update_offset(self._offset)
+
+    def fetch(self):
+        """One long poll; returns the (possibly empty) list of updates"""
+        params = {"timeout": self.timeout, "limit": self.limit, "allowed_updates": ["message", "callback_query"]}
+        if self._offset is not None:
+            params["offset"] = self._offset
+        self._count("polls")
+        # The HTTP timeout must outlast Telegram holding the request open
+        response_data = telegram.call("getUpdates", params, timeout=self.timeout + 10)
+        if not response_data.get("ok"):
+            raise RuntimeError(response_data.get("description"))
+        return response_data["result"]
+
+    def process_batch(self, updates):
+        """Handle a batch, concurrently across chats and in order within each chat"""
+        by_chat = {}
+        for update in updates:
+            if not is_valid_update(update):
+                continue
+            by_chat.setdefault(update_chat_id(update), []).append(update)
+
+        futures = [self._executor.submit(self._process_chat, chat_updates) for chat_updates in by_chat.values()]
+        for future in futures:
+            future.result()
+
+        self._count("batches")
+        self._count("updates", len(updates))
+        with self._stats_lock:
+            self._stats["largest_batch"] = max(self._stats["largest_batch"], len(updates))
+
+    def _process_chat(self, updates):
+        for update in updates:
+            if not update_deduplicator.is_duplicate(update["update_id"]):
+                self.handler(update)
+
+    def stop(self, timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Finish the batch in hand and save its offset"""
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["running"] = self._thread is not None and self._thread.is_alive()
+        stats["offset"] = self._offset
+        return stats
+
+update_poller = UpdatePoller(process_update, POLL_WORKERS, POLL_TIMEOUT, POLL_LIMIT)
+
+# -------------------------
+# Payment Success Page
+# -------------------------
+PAYMENT_SUCCESS_HTML = """
 <!DOCTYPE html>
 <html>
 <head>
@@ -559,36 +3388,36 @@ def payment_success():
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Payment Successful</title>
     <style>
-        * {{ margin: 0; padding: 0; box-sizing: border-box; }}
-        body {{
+        * { margin: 0; padding: 0; box-sizing: border-box; }
+        body {
             font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Arial, sans-serif;
             display: flex; justify-content: center; align-items: center;
             min-height: 100vh;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             padding: 20px;
-        }}
-        .container {{
+        }
+        .container {
             text-align: center; background: white; padding: 50px 40px;
             border-radius: 20px; box-shadow: 0 20px 60px rgba(0,0,0,0.3);
             max-width: 500px; animation: slideIn 0.5s ease-out;
-        }}
-        @keyframes slideIn {{ from {{ opacity: 0; transform: translateY(-30px); }} to {{ opacity: 1; transform: translateY(0); }} }}
-        .checkmark {{ font-size: 80px; margin-bottom: 20px; animation: bounce 0.6s ease-out; }}
-        @keyframes bounce {{ 0%, 100% {{ transform: scale(1); }} 50% {{ transform: scale(1.2); }} }}
-        h1 {{ color: #28a745; margin-bottom: 20px; font-size: 32px; font-weight: 700; }}
-        p {{ color: #555; font-size: 18px; margin: 15px 0; line-height: 1.6; }}
-        .highlight {{ background: #fff3cd; padding: 15px; border-radius: 10px; margin: 20px 0; border-left: 4px solid #ffc107; }}
-        .btn {{
+        }
+        @keyframes slideIn { from { opacity: 0; transform: translateY(-30px); } to { opacity: 1; transform: translateY(0); } }
+        .checkmark { font-size: 80px; margin-bottom: 20px; animation: bounce 0.6s ease-out; }
+        @keyframes bounce { 0%, 100% { transform: scale(1); } 50% { transform: scale(1.2); } }
+        h1 { color: #28a745; margin-bottom: 20px; font-size: 32px; font-weight: 700; }
+        p { color: #555; font-size: 18px; margin: 15px 0; line-height: 1.6; }
+        .highlight { background: #fff3cd; padding: 15px; border-radius: 10px; margin: 20px 0; border-left: 4px solid #ffc107; }
+        .btn {
             display: inline-block; margin-top: 30px; padding: 15px 50px;
             background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
             color: white; text-decoration: none; border-radius: 50px;
             font-weight: bold; font-size: 18px; transition: all 0.3s ease;
             box-shadow: 0 4px 15px rgba(102, 126, 234, 0.4);
-        }}
-        .btn:hover {{ transform: translateY(-2px); box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6); }}
-        .steps {{ text-align: left; margin: 25px 0; padding: 20px; background: #f8f9fa; border-radius: 10px; }}
-        .steps ol {{ margin-left: 20px; }}
-        .steps li {{ margin: 10px 0; color: #333; }}
+        }
+        .btn:hover { transform: translateY(-2px); box-shadow: 0 6px 20px rgba(102, 126, 234, 0.6); }
+        .steps { text-align: left; margin: 25px 0; padding: 20px; background: #f8f9fa; border-radius: 10px; }
+        .steps ol { margin-left: 20px; }
+        .steps li { margin: 10px 0; color: #333; }
     </style>
 </head>
 <body>
@@ -616,56 +3445,215 @@ def payment_success():
 </html>
 """
 
-@app.route(WEBHOOK_PATH, methods=["POST"])
-def webhook():
+# Split once so rendering is two concatenations around the only dynamic value
+_PAYMENT_PAGE_HEAD, _PAYMENT_PAGE_TAIL = PAYMENT_SUCCESS_HTML.split("{bot_username}")
+_payment_page_cache = {}
+
+def render_payment_success_page(bot_username):
+    """Encoded page and its ETag for a bot username"""
+    cached = _payment_page_cache.get(bot_username)
+    if cached is None:
+        body = (_PAYMENT_PAGE_HEAD + html.escape(bot_username) + _PAYMENT_PAGE_TAIL).encode("utf-8")
+        cached = (body, hashlib.sha1(body).hexdigest())
+        _payment_page_cache[bot_username] = cached
+    return cached
+
+def record_payment_success(user_id, semester, chat_id):
+    """Unlock the semester and tell the user; runs off the request path"""
     try:
-        print("📨 Webhook received")
-        
-        data = request.get_json()
-        if not data:
-            return "ok", 200
+        # Only the first confirmation messages the user, whichever worker or
+        # refresh of the success page gets here
+        if mark_semester_paid(user_id, semester):
+            success_text = (
+                f"✅ *Payment Successful!*\n\n"
+                f"🎉 *{semester} Unlocked!*\n\n"
+                f"📱 Return to Telegram and click 'I've Completed Payment' button."
+            )
+            send_message(chat_id, success_text)
+    except Exception as e:
+        log.exception("❌ Error: %s", e)
 
-        if "message" in data:
-            message = data["message"]
-            chat_id = message["chat"]["id"]
+# -------------------------
+# Flask Routes
+# -------------------------
+_bot_username_requested = False
 
-            if "text" in message and str(message["text"]).startswith("/start"):
-                print(f"🚀 Start: {chat_id}")
-                handle_start(chat_id)
+@app.before_request
+def start_background_services():
+    """Start per-worker background threads on the first request after fork"""
+    ensure_background_services()
 
-        elif "callback_query" in data:
-            cq = data["callback_query"]
-            cq_id = cq["id"]
-            chat_id = cq["message"]["chat"]["id"]
-            msg_id = cq["message"]["message_id"]
-            user_id = cq["from"]["id"]
-            cb_data = cq["data"]
+def ensure_background_services():
+    global _bot_username_requested
+    invalidation_bus.ensure_started()
+    payment_reconciler.ensure_started()
+    if not _bot_username and not _bot_username_requested and TOKEN:
+        _bot_username_requested = True
+        run_async(resolve_bot_username)
 
-            print(f"🔔 Callback: {cb_data}, user: {user_id}")
+@app.route("/")
+def home():
+    return "✅ Bot is Live!", 200
 
-            answer_callback_query(cq_id)
+@app.route("/stats")
+def stats():
+    """Per-worker runtime stats"""
+    return {
+        "db_pool": get_db_pool_stats(),
+        "dispatcher": update_dispatcher.get_stats(),
+        "update_dedup": update_deduplicator.get_stats(),
+        "http": get_http_stats(),
+        "telegram_outbound": outbound_scheduler.get_stats(),
+        "entitlement_cache": {
+            **entitlement_cache.get_stats(),
+            **_entitlement_stats,
+            "storage": ENTITLEMENT_STORAGE,
+        },
+        "catalog": get_catalog_stats(),
+        "payment_links": get_payment_link_stats(),
+        "session_buffer": session_buffer.get_stats(),
+        "invalidation_bus": invalidation_bus.get_stats(),
+        "logging": log_handler.get_stats(),
+        "poller": update_poller.get_stats(),
+        "user_lanes": user_lanes.get_stats(),
+        "payment_reconciler": payment_reconciler.get_stats(),
+        "event_log": event_log.get_stats(),
+        "render_memo": render_memo.get_stats(),
+    }, 200
 
-            if cb_data in semesters:
-                handle_semester_selection(chat_id, msg_id, user_id, cb_data)
-            elif cb_data.startswith("CHECK_PAYMENT_"):
-                semester = cb_data.replace("CHECK_PAYMENT_", "")
-                handle_check_payment(chat_id, msg_id, user_id, semester, cq_id)
-            elif cb_data == "BACK_SUBJECTS":
-                handle_back_to_subjects(chat_id, msg_id, user_id)
-            elif cb_data == "BACK_SEMESTERS":
-                handle_back_to_semesters(chat_id, msg_id, user_id)
-            else:
-                all_subjects = []
-                for sem_subjects in semesters.values():
-                    all_subjects.extend(sem_subjects)
-                if cb_data in all_subjects:
-                    handle_subject_selection(chat_id, msg_id, user_id, cb_data)
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # Also publish the numeric /stats counters as gauges
+    for section, values in stats()[0].items():
+        for key, value in values.items():
+            if isinstance(value, dict):
+                # Nested per-name stats, e.g. connection reuse per host
+                for sub_key, sub_value in value.items():
+                    if isinstance(sub_value, (int, float)) and not isinstance(sub_value, bool):
+                        lines.append(f'bot_{section}_{sub_key}{{name="{_escape_label(key)}"}} {sub_value}')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"bot_{section}_{key} {value}")
+    return "\n".join(lines) + "\n", 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/admin/reload_catalog", methods=["POST"])
+def admin_reload_catalog():
+    """Rescan PAPER_FOLDER in this and every other worker"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return "forbidden", 403
+    stats = reload_catalog()
+    invalidation_bus.publish({"kind": "catalog"})
+    return stats, 200
+
+@app.route("/admin/events", methods=["GET"])
+def admin_events():
+    """Event rollups for the last ?days=N days"""
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return "forbidden", 403
+    rollups = get_event_rollups(request.args.get("days", 7, type=int))
+    if rollups is None:
+        return "database unavailable", 503
+    return rollups, 200
+
+@app.route(PAYMENT_SUCCESS_PATH, methods=["GET"])
+def payment_success():
+    """Payment success page"""
+    user_id = request.args.get('user_id')
+    semester = request.args.get('semester')
+    chat_id = request.args.get('chat_id')
+    
+    payment_log.info("💰 Payment success: user=%s, semester=%s, chat=%s", user_id, semester, chat_id)
+    
+    if user_id and semester and chat_id:
+        try:
+            user_id = int(user_id)
+            chat_id = int(chat_id)
+            
+            # Skips the write for users already known to be unlocked here;
+            # record_payment_success itself only notifies on the first unlock
+            if not entitlement_cache.get(user_id, semester):
+                run_async(record_payment_success, user_id, semester, chat_id)
+        except Exception as e:
+            log.exception("❌ Error: %s", e)
+    
+    body, etag = render_payment_success_page(get_bot_username())
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+    return body, 200, {
+        "Content-Type": "text/html; charset=utf-8",
+        "Cache-Control": "private, max-age=600",
+        "ETag": f'"{etag}"',
+    }
+
+@app.route(f"{DOWNLOAD_PATH}/<token>", methods=["GET"])
+def download(token):
+    """Serve a catalog PDF for a signed link, with Range and conditional GET"""
+    claims = read_download_token(token)
+    if claims is None:
+        download_requests_total.inc(("invalid",))
+        return "invalid link", 403
+    if claims == "expired":
+        download_requests_total.inc(("expired",))
+        return "link expired, tap the subject in the bot again", 410
+
+    entry = catalog["subjects"].get(claims["subject"])
+    if not entry or entry["semester"] != claims["semester"] or claims["kind"] not in ("prev", "guess"):
+        download_requests_total.inc(("missing",))
+        return "not found", 404
+    file_info = entry[claims["kind"]]
+    if not file_info["available"]:
+        download_requests_total.inc(("missing",))
+        return "not found", 404
+
+    # conditional=True answers Range and If-None-Match/If-Modified-Since;
+    # the WSGI file_wrapper lets the server use sendfile for the body
+    try:
+        response = send_file(
+            os.path.abspath(file_info["path"]),
+            mimetype="application/pdf",
+            as_attachment=True,
+            download_name=os.path.basename(file_info["path"]),
+            conditional=True,
+            max_age=DOWNLOAD_TTL,
+        )
+    except FileNotFoundError:
+        download_requests_total.inc(("missing",))
+        return "not found", 404
+    download_requests_total.inc(("served",))
+    return response
 
+@app.route(WEBHOOK_PATH, methods=["POST"])
+def webhook():
+    try:
+        update_log.info("📨 Webhook received", extra=SAMPLED)
+        
+        if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+            return "forbidden", 403
+        
+        data = request.get_json(silent=True)
+        if not is_valid_update(data):
+            return "ok", 200
+        
+        if update_deduplicator.is_duplicate(data["update_id"]):
+            update_log.info("♻️ Duplicate update %s ignored", data['update_id'])
+            return "ok", 200
+        
+        if WEBHOOK_DISPATCH != "async":
+            process_update(data)
+            return "ok", 200
+        
+        if not update_dispatcher.submit(data):
+            # Queue is full: make Telegram back off and redeliver later, and
+            # un-record the update so the redelivery is not taken for a duplicate
+            update_deduplicator.forget(data["update_id"])
+            return "busy", 503, {"Retry-After": "1"}
         return "ok", 200
 
     except Exception as e:
-        print(f"❌ Error: {e}")
-        traceback.print_exc()
+        log.exception("❌ Error: %s", e)
         return "ok", 200
 
 @app.route(PAYMENT_WEBHOOK_PATH, methods=["POST"])
@@ -701,35 +3689,48 @@ def payment_webhook():
         
         return "ok", 200
     except Exception as e:
-        print(f"❌ Error: {e}")
+        log.exception("❌ Error: %s", e)
         return "ok", 200
 
 # -------------------------
 # Startup
 # -------------------------
 if __name__ == "__main__":
+    run_mode = "polling" if "--polling" in sys.argv else RUN_MODE
+    
     if DATABASE_URL:
         init_db()
     else:
-        print("⚠️ DATABASE_URL not set!")
+        log.warning("⚠️ DATABASE_URL not set!")
     
     if TOKEN:
         try:
-            requests.post(f"https://api.telegram.org/bot{TOKEN}/deleteWebhook", timeout=10)
-            print("🗑️ Webhook deleted")
+            # getUpdates is refused while a webhook is set
+            telegram.call("deleteWebhook")
+            log.info("🗑️ Webhook deleted")
             
-            response = requests.post(
-                f"https://api.telegram.org/bot{TOKEN}/setWebhook",
-                json={"url": WEBHOOK_URL, "allowed_updates": ["message", "callback_query"]},
-                timeout=10
-            )
-            print(f"🔗 Webhook: {response.json()}")
-            
-            info = requests.get(f"https://api.telegram.org/bot{TOKEN}/getWebhookInfo", timeout=10)
-            print(f"ℹ️ Info: {info.json()}")
+            if run_mode == "webhook":
+                webhook_config = {"url": WEBHOOK_URL, "allowed_updates": ["message", "callback_query"]}
+                if WEBHOOK_SECRET:
+                    webhook_config["secret_token"] = WEBHOOK_SECRET
+                log.info("🔗 Webhook: %s", telegram.call('setWebhook', webhook_config))
+                log.info("ℹ️ Info: %s", telegram.call('getWebhookInfo'))
+            resolve_bot_username()
         except Exception as e:
-            print(f"❌ Error: {e}")
+            log.error("❌ Error: %s", e)
+
+    # Turn SIGTERM into a normal exit so atexit hooks drain the queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_catalog())
+
+    if run_mode == "polling":
+        # Claims must survive a crash for the re-fetched batch to skip them
+        update_deduplicator.use_db = bool(DATABASE_URL)
+        ensure_background_services()
+        update_poller.start()
+        atexit.register(update_poller.stop)
 
+    # Still serves the Razorpay webhook, payment page and /stats when polling
     port = int(os.environ.get("PORT", 10000))
-    print(f"🚀 Server starting on port {port}")
+    log.info("🚀 Server starting on port %s (%s mode)", port, run_mode)
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,943 @@
+"""Load benchmark for the bot, run entirely on this machine.
+
+The Flask app is driven in-process with synthetic update streams while
+its outbound calls go to local fake Telegram and Razorpay servers. Those
+servers record every call and can inject latency, 429s and errors.
+Postgres is either a real local database (--database-url) or an
+in-process stand-in that simulates round-trip latency.
+
+    python benchmark.py run --scenario subject_burst --updates 500 --rate 50
+    python benchmark.py run --scenario mixed --telegram-429-rate 0.02 --output after.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py pool
+"""
+import argparse
+import csv
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_TOKEN = "bench-token"
+BENCH_RAZORPAY_SECRET = "bench-secret"
+MENU_MESSAGE_BASE = 10 ** 9
+SCENARIOS = ["start_storm", "subject_burst", "paywall", "payment_webhooks", "mixed"]
+
+
+# -------------------------
+# Fake upstream servers
+# -------------------------
+class FaultConfig:
+    def __init__(self, latency_ms=0.0, rate_429=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency_ms / 1000
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+
+
+class FakeServer:
+    """Threaded HTTP server that records calls and injects faults"""
+
+    def __init__(self, faults):
+        self.faults = faults
+        self.calls = defaultdict(int)
+        self.injected = defaultdict(int)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1000)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server._handle(self, b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                server._handle(self, body)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def next_id(self):
+        return next(self._ids)
+
+    def _handle(self, request, body):
+        operation = self.operation(request.command, request.path)
+        with self._lock:
+            self.calls[operation] += 1
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+
+        roll = random.random()
+        if roll < self.faults.rate_429:
+            with self._lock:
+                self.injected["429"] += 1
+            status, payload = 429, self.throttled()
+        elif roll < self.faults.rate_429 + self.faults.error_rate:
+            with self._lock:
+                self.injected["5xx"] += 1
+            status, payload = 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        else:
+            status, payload = self.respond(operation, request.path, body)
+
+        data = json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def operation(self, command, path):
+        raise NotImplementedError
+
+    def respond(self, operation, path, body):
+        raise NotImplementedError
+
+    def throttled(self):
+        return {"error": "rate limited"}
+
+    def report(self):
+        with self._lock:
+            return {"calls": dict(self.calls), "injected": dict(self.injected)}
+
+    def close(self):
+        self.httpd.shutdown()
+
+
+class FakeTelegram(FakeServer):
+    """Bot API stand-in answering the methods the bot uses.
+
+    Sent and edited messages are kept, so callbacks can carry the tapped
+    message as it currently looks, like real updates do.
+    """
+
+    def __init__(self, faults):
+        super().__init__(faults)
+        self.messages = {}
+
+    def snapshot(self, chat_id, message_id):
+        with self._lock:
+            message = self.messages.get((chat_id, message_id))
+        return dict(message or {"message_id": message_id, "chat": {"id": chat_id}})
+
+    def operation(self, command, path):
+        return path.rsplit("/", 1)[-1].split("?")[0]
+
+    def throttled(self):
+        return {
+            "ok": False,
+            "error_code": 429,
+            "description": "Too Many Requests: retry later",
+            "parameters": {"retry_after": self.faults.retry_after},
+        }
+
+    def document(self):
+        return {"message_id": self.next_id(), "document": {"file_id": f"BENCH{self.next_id()}"}}
+
+    def respond(self, method, path, body):
+        if method == "sendMediaGroup":
+            count = max(1, body.count(b'"type": "document"'))
+            return 200, {"ok": True, "result": [self.document() for _ in range(count)]}
+        if method == "sendDocument":
+            return 200, {"ok": True, "result": self.document()}
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "username": "BenchBot"}}
+        if method in ("sendMessage", "editMessageText"):
+            payload = json.loads(body or b"{}")
+            chat_id = payload.get("chat_id")
+            message_id = payload["message_id"] if method == "editMessageText" else self.next_id()
+            message = {"message_id": message_id, "chat": {"id": chat_id}, "text": payload.get("text")}
+            markup = payload.get("reply_markup")
+            if markup:
+                message["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+            with self._lock:
+                self.messages[(chat_id, message_id)] = message
+            return 200, {"ok": True, "result": message}
+        return 200, {"ok": True, "result": True}
+
+
+class FakeRazorpay(FakeServer):
+    """Payment Links API stand-in.
+
+    A paid_rate fraction of created links are reported as paid by the list
+    and fetch endpoints without any webhook being sent, like a payment
+    whose notifications were lost.
+    """
+
+    def __init__(self, faults, paid_rate=0.0):
+        super().__init__(faults)
+        self.paid_rate = paid_rate
+        self.links = []
+
+    def operation(self, command, path):
+        path = re.sub(r"/plink_\w+", "/{id}", path.split("?")[0])
+        return f"{command} {path}"
+
+    def respond(self, operation, path, body):
+        if operation == "POST /v1/payment_links":
+            payload = json.loads(body or b"{}")
+            link_id = f"plink_{self.next_id()}"
+            link = {
+                "id": link_id,
+                "short_url": f"https://rzp.io/i/{link_id}",
+                "status": "paid" if random.random() < self.paid_rate else "created",
+                "amount": payload.get("amount"),
+                "notes": payload.get("notes", {}),
+                "expire_by": payload.get("expire_by", 0),
+                "created_at": int(time.time()),
+            }
+            with self._lock:
+                self.links.append(link)
+            return 200, link
+        if operation == "GET /v1/payment_links/{id}":
+            link_id = urlparse(path).path.rsplit("/", 1)[-1]
+            with self._lock:
+                link = next((link for link in self.links if link["id"] == link_id), None)
+            if link is not None:
+                return 200, link
+        elif operation == "GET /v1/payment_links":
+            query = parse_qs(urlparse(path).query)
+            count = int(query.get("count", ["10"])[0])
+            skip = int(query.get("skip", ["0"])[0])
+            with self._lock:
+                links = list(reversed(self.links))
+            return 200, {"payment_links": links[skip:skip + count]}
+        return 404, {"error": {"code": "BAD_REQUEST_ERROR", "description": "not found"}}
+
+
+# -------------------------
+# In-process Postgres stand-in
+# -------------------------
+class MemoryDatabase:
+    """Dict-backed stand-in for the bot's tables.
+
+    It understands exactly the statements app.py issues and raises on
+    anything else, so a new query shows up as a loud benchmark failure
+    rather than silently skewing results. Each transaction sleeps for
+    the configured round-trip latency.
+    """
+
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+        self.lock = threading.RLock()
+        self.payments = set()
+        self.entitlements = {}
+        self.sessions = {}
+        self.documents = {}
+        self.payment_links = {}
+        self.processed_updates = set()
+        self.job_runs = {}
+        self.events = []
+        self.rollups = {}
+
+    @contextmanager
+    def cursor(self):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            yield MemoryCursor(self)
+
+
+class MemoryCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rowcount = 0
+        self._rows = []
+
+    def execute(self, sql, params=()):
+        statement = " ".join(sql.split())
+        for marker, handler in self.HANDLERS:
+            if marker in statement:
+                result = handler(self, *(params or ()))
+                self._rows = list(result or [])
+                return
+        raise NotImplementedError(f"MemoryDatabase does not understand: {statement[:120]}")
+
+    def fetchone(self):
+        return self._rows[0] if self._rows else None
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def execute_values(self, sql, rows):
+        statement = " ".join(sql.split())
+        if "INSERT INTO user_sessions" in statement:
+            for user_id, semester, nav_message_id in rows:
+                self.db.sessions[user_id] = (semester, nav_message_id)
+        elif "INSERT INTO user_payments" in statement:
+            self.db.payments.update((user_id, semester) for user_id, semester in rows)
+        elif "INSERT INTO user_entitlements" in statement:
+            for user_id, bits in rows:
+                self.db.entitlements[user_id] = self.db.entitlements.get(user_id, 0) | bits
+        elif "INSERT INTO event_rollup_" in statement:
+            table = statement.split()[2]
+            for *key, count in rows:
+                self.db.rollups[(table, *key)] = self.db.rollups.get((table, *key), 0) + count
+        else:
+            raise NotImplementedError(f"MemoryDatabase does not batch: {statement[:80]}")
+        self.rowcount = len(rows)
+
+    def copy_expert(self, sql, stream):
+        if "COPY bot_events" not in sql:
+            raise NotImplementedError(f"MemoryDatabase does not COPY: {sql[:80]}")
+        rows = list(csv.reader(stream))
+        self.db.events.extend(rows)
+        self.rowcount = len(rows)
+
+    def _paid_rows(self, user_id):
+        return [semester for uid, semester in self.db.payments if uid == user_id]
+
+    def _user_state(self, user_id, *_):
+        session = self.db.sessions.get(user_id, (None, None))
+        return [(session[0], session[1], self._paid_rows(user_id), self.db.entitlements.get(user_id))]
+
+    def _entitlements(self, user_id, *_):
+        return [(self._paid_rows(user_id), self.db.entitlements.get(user_id))]
+
+    def _entitlements_batch(self, user_ids):
+        return [(user_id, self._paid_rows(user_id), self.db.entitlements.get(user_id)) for user_id in user_ids]
+
+    def _insert_payment(self, user_id, semester):
+        self.rowcount = 0 if (user_id, semester) in self.db.payments else 1
+        self.db.payments.add((user_id, semester))
+
+    def _insert_entitlement(self, user_id, bits):
+        current = self.db.entitlements.get(user_id)
+        self.rowcount = 0 if current is not None and current & bits == bits else 1
+        self.db.entitlements[user_id] = (current or 0) | bits
+
+    def _notify(self, *_):
+        return [("",)]
+
+    def _write_session(self, user_id, semester, nav_message_id, *_):
+        self.db.sessions[user_id] = (semester, nav_message_id)
+        self.rowcount = 1
+
+    def _read_session(self, user_id):
+        session = self.db.sessions.get(user_id)
+        return [session] if session else []
+
+    def _read_document(self, path):
+        document = self.db.documents.get(path)
+        return [document] if document else []
+
+    def _write_document(self, path, size, mtime_ns, file_id):
+        self.db.documents[path] = (size, mtime_ns, file_id)
+
+    def _delete_document(self, path):
+        self.db.documents.pop(path, None)
+
+    def _read_link(self, user_id, semester):
+        link = self.db.payment_links.get((user_id, semester))
+        return [link] if link else []
+
+    def _write_link(self, user_id, semester, link_id, short_url, expire_by):
+        self.db.payment_links[(user_id, semester)] = (link_id, short_url, expire_by)
+
+    def _claim_update(self, update_id):
+        self.rowcount = 0 if update_id in self.db.processed_updates else 1
+        self.db.processed_updates.add(update_id)
+
+    def _advisory_lock(self, key):
+        # Every transaction already holds the stand-in's single lock
+        return [(True,)]
+
+    def _claim_job_run(self, name, min_seconds):
+        last_run = self.db.job_runs.get(name)
+        self.rowcount = 0 if last_run is not None and time.time() - last_run < min_seconds else 1
+        if self.rowcount:
+            self.db.job_runs[name] = time.time()
+
+    def _ignore(self, *_):
+        self.rowcount = 0
+
+    HANDLERS = [
+        ("LEFT JOIN user_sessions s", _user_state),
+        ("SELECT ARRAY(SELECT semester FROM user_payments", _entitlements),
+        ("FROM unnest(%s::bigint[]) AS u(id)", _entitlements_batch),
+        ("INSERT INTO user_payments", _insert_payment),
+        ("INSERT INTO user_entitlements (user_id, semesters_mask) VALUES", _insert_entitlement),
+        ("SELECT pg_notify", _notify),
+        ("INSERT INTO user_sessions", _write_session),
+        ("FROM user_sessions WHERE user_id", _read_session),
+        ("FROM document_cache WHERE", _read_document),
+        ("INSERT INTO document_cache", _write_document),
+        ("DELETE FROM document_cache", _delete_document),
+        ("FROM payment_links WHERE", _read_link),
+        ("INSERT INTO payment_links", _write_link),
+        ("INSERT INTO processed_updates", _claim_update),
+        ("DELETE FROM processed_updates", _ignore),
+        ("SELECT pg_try_advisory_xact_lock", _advisory_lock),
+        ("INSERT INTO job_runs", _claim_job_run),
+        ("CREATE TABLE IF NOT EXISTS bot_events_", _ignore),
+    ]
+
+
+def install_memory_database(app, db):
+    """Point app's database helpers at the in-process stand-in"""
+    import psycopg2.extras
+
+    original_execute_values = psycopg2.extras.execute_values
+
+    def execute_values(cursor, sql, rows, *args, **kwargs):
+        if isinstance(cursor, MemoryCursor):
+            return cursor.execute_values(sql, rows)
+        return original_execute_values(cursor, sql, rows, *args, **kwargs)
+
+    @contextmanager
+    def db_cursor():
+        app.db_transactions_total.inc()
+        with db.cursor() as cursor:
+            yield cursor
+
+    psycopg2.extras.execute_values = execute_values
+    app.db_cursor = db_cursor
+    app.DATABASE_URL = "memory://benchmark"
+    app.payment_reconciler.enabled = bool(app.RAZORPAY_KEY_ID)
+
+
+class FakePostgres:
+    """Just enough of the Postgres wire protocol for libpq to connect.
+
+    Every query succeeds with no rows except SELECT, which returns a single
+    1. Used to drive the real connection pool without a database server.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.clients = set()
+        self.queries = defaultdict(int)
+        self._lock = threading.Lock()
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.url = f"postgresql://bench@127.0.0.1:{self.sock.getsockname()[1]}/bench?sslmode=disable"
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _read(conn, size):
+        data = b""
+        while len(data) < size:
+            chunk = conn.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("client went away")
+            data += chunk
+        return data
+
+    @staticmethod
+    def _message(kind, payload=b""):
+        return kind + struct.pack("!I", len(payload) + 4) + payload
+
+    def _serve(self, conn):
+        with self._lock:
+            self.clients.add(conn)
+        with conn:
+            try:
+                # SSL/GSS negotiation requests come before the startup packet
+                while True:
+                    length, code = struct.unpack("!II", self._read(conn, 8))
+                    self._read(conn, length - 8)
+                    if code in (80877103, 80877104):
+                        conn.sendall(b"N")
+                        continue
+                    break
+                with self._lock:
+                    self.connections += 1
+                reply = self._message(b"R", struct.pack("!I", 0))
+                for name, value in (("server_version", "16.0"), ("client_encoding", "UTF8"),
+                                    ("DateStyle", "ISO, MDY"), ("integer_datetimes", "on"),
+                                    ("standard_conforming_strings", "on")):
+                    reply += self._message(b"S", f"{name}\0{value}\0".encode())
+                reply += self._message(b"K", struct.pack("!II", os.getpid(), 0))
+                status = b"I"
+                conn.sendall(reply + self._message(b"Z", status))
+
+                while True:
+                    kind = self._read(conn, 1)
+                    length, = struct.unpack("!I", self._read(conn, 4))
+                    body = self._read(conn, length - 4)
+                    if kind == b"X":
+                        return
+                    if kind != b"Q":
+                        continue
+                    sql = body.rstrip(b"\0").decode().strip()
+                    command = sql.split(None, 1)[0].upper() if sql else ""
+                    with self._lock:
+                        self.queries[command] += 1
+                    reply = b""
+                    if command == "BEGIN":
+                        status, tag = b"T", "BEGIN"
+                    elif command in ("COMMIT", "ROLLBACK"):
+                        status, tag = b"I", command
+                    elif command == "SELECT":
+                        column = b"?column?\0" + struct.pack("!IhIhih", 0, 0, 23, 4, -1, 0)
+                        reply += self._message(b"T", struct.pack("!h", 1) + column)
+                        reply += self._message(b"D", struct.pack("!hI", 1, 1) + b"1")
+                        tag = "SELECT 1"
+                    else:
+                        tag = command
+                    reply += self._message(b"C", tag.encode() + b"\0")
+                    conn.sendall(reply + self._message(b"Z", status))
+            except (ConnectionError, OSError):
+                return
+            finally:
+                with self._lock:
+                    self.clients.discard(conn)
+
+    def restart(self):
+        """Hang up on every client, like a server restart"""
+        with self._lock:
+            clients = list(self.clients)
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        self.sock.close()
+
+
+# -------------------------
+# Workloads
+# -------------------------
+class UpdateFactory:
+    def __init__(self, semester_names, subjects_by_semester):
+        self.semesters = semester_names
+        self.subjects = subjects_by_semester
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+
+    def message(self, user_id, text):
+        return ("webhook", {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "from": {"id": user_id},
+                "chat": {"id": user_id, "type": "private"},
+                "text": text,
+            },
+        })
+
+    def callback(self, user_id, data):
+        return ("webhook", {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._callback_ids)),
+                "from": {"id": user_id},
+                # Users keep tapping their menu message; the runner fills in its current content
+                "message": {"message_id": MENU_MESSAGE_BASE + user_id, "chat": {"id": user_id}},
+                "data": data,
+            },
+        })
+
+    def payment_webhook(self, user_id, semester):
+        body = json.dumps({
+            "event": "payment_link.paid",
+            "payload": {"payment_link": {"entity": {
+                "id": f"plink_bench{user_id}",
+                "status": "paid",
+                "notes": {"user_id": str(user_id), "chat_id": str(user_id), "semester": semester},
+            }}},
+        }).encode()
+        signature = hmac.new(BENCH_RAZORPAY_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        return ("payment_webhook", body, {"X-Razorpay-Signature": signature, "Content-Type": "application/json"})
+
+
+def build_workload(scenario, count, users, factory, rng):
+    """Synthetic stream of (kind, payload...) items plus users to seed as paid"""
+    paid = {}
+    items = []
+
+    def user():
+        return rng.randint(1, users)
+
+    def semester_of(user_id):
+        return factory.semesters[user_id % len(factory.semesters)]
+
+    def subject_session(user_id):
+        semester = semester_of(user_id)
+        paid[user_id] = semester
+        subjects = factory.subjects[semester]
+        return [
+            factory.callback(user_id, semester),
+            factory.callback(user_id, rng.choice(subjects)),
+            factory.callback(user_id, "BACK_SUBJECTS"),
+            factory.callback(user_id, rng.choice(subjects)),
+            factory.callback(user_id, "BACK_SEMESTERS"),
+        ]
+
+    def paywall_session(user_id):
+        semester = semester_of(user_id)
+        return [
+            factory.callback(user_id, semester),
+            factory.callback(user_id, f"CHECK_PAYMENT_{semester}"),
+            factory.callback(user_id, "BACK_SEMESTERS"),
+            factory.callback(user_id, semester),
+        ]
+
+    generators = {
+        "start_storm": lambda: [factory.message(user(), "/start")],
+        "subject_burst": lambda: subject_session(user()),
+        "paywall": lambda: paywall_session(user()),
+        "payment_webhooks": lambda: [(lambda u: factory.payment_webhook(u, semester_of(u)))(user())],
+    }
+    mix = ["start_storm"] * 2 + ["subject_burst"] * 5 + ["paywall"] * 2 + ["payment_webhooks"]
+
+    while len(items) < count:
+        name = rng.choice(mix) if scenario == "mixed" else scenario
+        items.extend(generators[name]())
+    return items[:count], paid
+
+
+# -------------------------
+# Runner
+# -------------------------
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(1000 * sum(ordered) / len(ordered), 3),
+        "p50_ms": round(1000 * pick(0.50), 3),
+        "p95_ms": round(1000 * pick(0.95), 3),
+        "p99_ms": round(1000 * pick(0.99), 3),
+        "max_ms": round(1000 * ordered[-1], 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    random.seed(args.seed)
+    telegram_server = FakeTelegram(FaultConfig(
+        args.telegram_latency_ms, args.telegram_429_rate, args.telegram_error_rate, args.retry_after
+    ))
+    razorpay_server = FakeRazorpay(
+        FaultConfig(args.razorpay_latency_ms, 0.0, args.razorpay_error_rate), args.razorpay_lost_webhook_rate
+    )
+
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "BOT_USERNAME": "BenchBot",
+        "TELEGRAM_API_URL": telegram_server.url,
+        "RAZORPAY_API_URL": razorpay_server.url,
+        "RAZORPAY_KEY_ID": "rzp_bench",
+        "RAZORPAY_KEY_SECRET": BENCH_RAZORPAY_SECRET,
+        "WEBHOOK_DISPATCH": args.dispatch,
+    })
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        os.environ.pop("DATABASE_URL", None)
+        os.environ["INVALIDATION_BUS"] = "0"
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    db = None
+    if args.database_url:
+        app.init_db()
+    else:
+        db = MemoryDatabase(args.db_latency_ms)
+        install_memory_database(app, db)
+
+    # Keep raw samples next to the app's own histograms for exact percentiles
+    samples = defaultdict(lambda: defaultdict(list))
+    samples_lock = threading.Lock()
+    original_observe = app.Histogram.observe
+
+    def observe(histogram, labels, value):
+        with samples_lock:
+            samples[histogram.name][labels[0]].append(value)
+        original_observe(histogram, labels, value)
+
+    app.Histogram.observe = observe
+
+    rng = random.Random(args.seed)
+    factory = UpdateFactory(list(app.semesters), app.semesters)
+    items, paid = build_workload(args.scenario, args.updates, args.users, factory, rng)
+    for user_id, semester in paid.items():
+        if db is not None:
+            db.payments.add((user_id, semester))
+            db.entitlements[user_id] = db.entitlements.get(user_id, 0) | app.SEMESTER_BITS[semester]
+        else:
+            app.mark_semester_paid(user_id, semester)
+    if not args.warm_caches:
+        app.entitlement_cache.clear()
+
+    request_latency = defaultdict(list)
+    status_codes = defaultdict(int)
+    client_local = threading.local()
+
+    def send(item):
+        client = getattr(client_local, "client", None)
+        if client is None:
+            client = client_local.client = app.app.test_client()
+        callback = item[1].get("callback_query") if item[0] == "webhook" else None
+        if callback:
+            message = callback["message"]
+            callback["message"] = telegram_server.snapshot(message["chat"]["id"], message["message_id"])
+        start = time.perf_counter()
+        if item[0] == "webhook":
+            response = client.post(app.WEBHOOK_PATH, json=item[1])
+        else:
+            response = client.post(app.PAYMENT_WEBHOOK_PATH, data=item[1], headers=item[2])
+        elapsed = time.perf_counter() - start
+        with samples_lock:
+            request_latency[item[0]].append(elapsed)
+            status_codes[response.status_code] += 1
+
+    print(f"🏁 {args.scenario}: {len(items)} updates at {args.rate}/s, dispatch={args.dispatch}")
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = []
+        for i, item in enumerate(items):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(send, item))
+        for future in futures:
+            future.result()
+    if args.dispatch == "async":
+        app.update_dispatcher.queue.join()
+    elapsed = time.perf_counter() - started
+    app.session_buffer.flush()
+    app.event_log.flush()
+
+    telegram_report = telegram_server.report()
+    razorpay_report = razorpay_server.report()
+    telegram_calls = sum(telegram_report["calls"].values())
+    razorpay_calls = sum(razorpay_report["calls"].values())
+    db_round_trips = sum(app.db_transactions_total._values.values())
+    count = len(items)
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "updates": count,
+        "duration_seconds": round(elapsed, 3),
+        "achieved_rate": round(count / elapsed, 2) if elapsed else None,
+        "status_codes": dict(status_codes),
+        "request_latency": {kind: percentiles(values) for kind, values in request_latency.items()},
+        "handlers": {name: percentiles(values) for name, values in samples["bot_handler_seconds"].items()},
+        "telegram_methods": {name: percentiles(values) for name, values in samples["bot_telegram_request_seconds"].items()},
+        "razorpay_operations": {name: percentiles(values) for name, values in samples["bot_razorpay_request_seconds"].items()},
+        "db_helpers": {name: percentiles(values) for name, values in samples["bot_db_seconds"].items()},
+        "outbound_calls": {
+            "telegram": telegram_report,
+            "razorpay": razorpay_report,
+            "telegram_per_update": round(telegram_calls / count, 3),
+            "razorpay_per_update": round(razorpay_calls / count, 3),
+        },
+        "db_round_trips": {"total": db_round_trips, "per_update": round(db_round_trips / count, 3)},
+        "errors": {"/".join(labels): value for labels, value in app.errors_total._values.items()},
+        "document_bytes_uploaded": sum(app.document_bytes_total._values.values()),
+        "stats": app.stats()[0],
+    }
+
+    telegram_server.close()
+    razorpay_server.close()
+    app.update_dispatcher.shutdown(5)
+
+    print(json.dumps({
+        key: report[key] for key in ("duration_seconds", "achieved_rate", "status_codes", "request_latency", "handlers")
+    }, indent=2))
+    print(f"📞 Telegram calls/update: {report['outbound_calls']['telegram_per_update']}, "
+          f"Razorpay calls/update: {report['outbound_calls']['razorpay_per_update']}, "
+          f"DB round trips/update: {report['db_round_trips']['per_update']}")
+
+    output = args.output or f"benchmark-{args.scenario}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"💾 Report saved to {output}")
+    return 0
+
+
+def check_pool(args):
+    """Run the real pool helpers against FakePostgres and check reuse"""
+    fake = FakePostgres()
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "DATABASE_URL": fake.url,
+        "DB_POOL_MIN": "1",
+        "DB_POOL_MAX": "4",
+        "INVALIDATION_BUS": "0",
+    })
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    failures = []
+
+    def checkouts(count, concurrency):
+        def one(_):
+            with app.db_cursor() as cursor:
+                if cursor is None:
+                    return False
+                cursor.execute("SELECT 1")
+                return cursor.fetchone() == (1,)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(one, range(count)))
+        if not all(results):
+            failures.append(f"{results.count(False)} of {count} checkouts failed")
+
+    # Recently used connections are handed out without a round trip
+    checkouts(args.checkouts, 1)
+    stats = app.get_db_pool_stats()
+    if fake.connections != 1:
+        failures.append(f"sequential checkouts opened {fake.connections} connections, expected 1")
+    if stats["healthchecks"]:
+        failures.append(f"{stats['healthchecks']} healthchecks on connections that were just used")
+
+    # Concurrent checkouts stay within DB_POOL_MAX and are reused afterwards
+    checkouts(args.checkouts, 8)
+    opened = fake.connections
+    if opened > app.DB_POOL_MAX:
+        failures.append(f"{opened} connections opened with DB_POOL_MAX={app.DB_POOL_MAX}")
+    checkouts(args.checkouts, 8)
+    if fake.connections != opened:
+        failures.append(f"{fake.connections - opened} new connections after the pool was warm")
+
+    # Connections the server hung up on are replaced before anyone uses them
+    before = app.get_db_pool_stats()
+    fake.restart()
+    time.sleep(0.1)
+    checkouts(args.checkouts, 8)
+    stats = app.get_db_pool_stats()
+    if not stats["reconnects"] > before["reconnects"]:
+        failures.append("dropped connections were not replaced")
+    if stats["errors"]:
+        failures.append(f"{stats['errors']} errors after the server restarted")
+    reconnects = stats["reconnects"]
+
+    # Idle connections are pinged once, then reused
+    app.DB_POOL_HEALTHCHECK_IDLE = 0
+    checkouts(1, 1)
+    stats = app.get_db_pool_stats()
+    if not stats["healthchecks"]:
+        failures.append("idle connection was not health-checked")
+    if stats["reconnects"] != reconnects or stats["errors"] or stats["timeouts"]:
+        failures.append(f"unexpected pool events: {stats}")
+
+    print(f"connections opened: {fake.connections}, queries: {dict(fake.queries)}")
+    print(f"pool stats: {app.get_db_pool_stats()}")
+    fake.close()
+    for failure in failures:
+        print(f"❌ {failure}")
+    if not failures:
+        print("✅ pool reuses connections")
+    return 1 if failures else 0
+
+
+def compare(args):
+    """Print p50/p95/p99 and per-update cost changes between two reports"""
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    def row(label, old, new):
+        if old is None or new is None:
+            change = ""
+        elif old:
+            change = f"{100 * (new - old) / old:+.1f}%"
+        else:
+            change = "n/a"
+        print(f"  {label:<48} {old!s:>10} -> {new!s:>10} {change}")
+
+    print(f"{before.get('revision')} -> {after.get('revision')}")
+    for section in ("request_latency", "handlers", "telegram_methods", "razorpay_operations", "db_helpers"):
+        names = sorted(set(before.get(section, {})) | set(after.get(section, {})))
+        if names:
+            print(section)
+        for name in names:
+            old = before.get(section, {}).get(name, {})
+            new = after.get(section, {}).get(name, {})
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                row(f"{name} {q}", old.get(q), new.get(q))
+    print("cost per update")
+    row("telegram calls", before["outbound_calls"]["telegram_per_update"], after["outbound_calls"]["telegram_per_update"])
+    row("razorpay calls", before["outbound_calls"]["razorpay_per_update"], after["outbound_calls"]["razorpay_per_update"])
+    row("db round trips", before["db_round_trips"]["per_update"], after["db_round_trips"]["per_update"])
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="replay a synthetic workload")
+    run_parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    run_parser.add_argument("--updates", type=int, default=500)
+    run_parser.add_argument("--rate", type=float, default=50, help="target updates per second")
+    run_parser.add_argument("--users", type=int, default=200)
+    run_parser.add_argument("--concurrency", type=int, default=32, help="simultaneous webhook requests")
+    run_parser.add_argument("--dispatch", choices=["sync", "async"], default="sync")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--warm-caches", action="store_true", help="keep entitlements cached from seeding")
+    run_parser.add_argument("--database-url", help="local Postgres; default is the in-process stand-in")
+    run_parser.add_argument("--db-latency-ms", type=float, default=2.0, help="stand-in round-trip time")
+    run_parser.add_argument("--telegram-latency-ms", type=float, default=40.0)
+    run_parser.add_argument("--telegram-429-rate", type=float, default=0.0)
+    run_parser.add_argument("--telegram-error-rate", type=float, default=0.0)
+    run_parser.add_argument("--retry-after", type=int, default=1, help="retry_after sent with injected 429s")
+    run_parser.add_argument("--razorpay-latency-ms", type=float, default=150.0)
+    run_parser.add_argument("--razorpay-error-rate", type=float, default=0.0)
+    run_parser.add_argument("--razorpay-lost-webhook-rate", type=float, default=0.0,
+                            help="fraction of links paid without a webhook, left for the reconciler")
+    run_parser.add_argument("--output", help="JSON report path (default benchmark-<scenario>.json)")
+
+    compare_parser = commands.add_parser("compare", help="diff two JSON reports")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    pool_parser = commands.add_parser("pool", help="check connection reuse in the real DB pool")
+    pool_parser.add_argument("--checkouts", type=int, default=50)
+
+    args = parser.parse_args()
+    if args.command == "pool":
+        return check_pool(args)
+    return run(args) if args.command == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,44 @@
+"""Move semester entitlements from user_payments rows to the bitmap table.
+
+Rollout:
+  1. Deploy with ENTITLEMENT_STORAGE=dual so new payments land in both tables
+  2. python migrate_entitlements.py backfill
+  3. python migrate_entitlements.py verify   (repeat until it reports no differences)
+  4. Deploy with ENTITLEMENT_STORAGE=bitmap
+"""
+import argparse
+import sys
+
+import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backfill", "verify"])
+    parser.add_argument("--limit", type=int, default=100, help="max differences to print when verifying")
+    args = parser.parse_args()
+
+    if not app.DATABASE_URL:
+        print("❌ DATABASE_URL not set!")
+        return 1
+    app.init_db()
+
+    if args.command == "backfill":
+        result = app.backfill_entitlement_bitmap()
+        print(f"✅ Backfilled entitlement bitmap for {result['users']} users")
+        for semester, count in result["unknown_semesters"].items():
+            print(f"⚠️ {count} payments for unknown semester {semester!r} have no bit and were skipped")
+        return 0
+
+    differences = app.verify_entitlement_bitmap(args.limit)
+    for diff in differences:
+        print(f"❌ user={diff['user_id']} rows={diff['rows_mask']:08b} bitmap={diff['bitmap_mask']:08b}")
+    if differences:
+        print(f"⚠️ {len(differences)} users differ (showing at most {args.limit})")
+        return 1
+    print("✅ Bitmap matches user_payments")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
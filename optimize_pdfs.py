@@ -0,0 +1,211 @@
+"""Write size-optimized copies of the PDFs in PAPER_FOLDER.
+
+Each PDF is rewritten with pikepdf (pip install pikepdf). Content
+streams are recompressed, unreferenced resources dropped, objects packed
+into object streams and, with --linearize, laid out for fast first-page
+display. With --downsample-dpi the file first goes through Ghostscript
+(gs) so images are downsampled and repeated images stored once.
+
+Output goes to OPTIMIZED_FOLDER under the same relative paths, and the
+bot serves those copies instead of the originals while the source hash in
+the manifest still matches. Files whose source hash and options are
+unchanged since the last run are skipped. If an optimized
+copy would not be smaller, no copy is written and the original is used.
+
+    python optimize_pdfs.py
+    python optimize_pdfs.py --downsample-dpi 150 --linearize --report report.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Same locations app.py uses; importing app would start the whole bot
+PAPER_FOLDER = "bpharm_bot_18"
+OPTIMIZED_FOLDER = os.getenv("OPTIMIZED_FOLDER", PAPER_FOLDER + "_optimized")
+MANIFEST_NAME = "manifest.json"
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_pdfs(source_root):
+    for folder, _, filenames in os.walk(source_root):
+        for filename in sorted(filenames):
+            if filename.endswith(".pdf"):
+                yield os.path.relpath(os.path.join(folder, filename), source_root)
+
+
+def ghostscript_downsample(source, target, dpi):
+    subprocess.run(
+        [
+            "gs", "-q", "-dBATCH", "-dNOPAUSE", "-dSAFER", "-sDEVICE=pdfwrite",
+            "-dCompatibilityLevel=1.5", "-dDetectDuplicateImages=true",
+            "-dDownsampleColorImages=true", f"-dColorImageResolution={dpi}",
+            "-dDownsampleGrayImages=true", f"-dGrayImageResolution={dpi}",
+            "-dDownsampleMonoImages=true", f"-dMonoImageResolution={dpi * 2}",
+            f"-sOutputFile={target}", source,
+        ],
+        check=True,
+        timeout=600,
+    )
+
+
+def optimize_file(source, target, options):
+    """Write an optimized copy of source to target; returns a report row.
+
+    Runs in a worker process, so it only takes and returns plain values.
+    """
+    import pikepdf
+
+    start = time.perf_counter()
+    source_size = os.path.getsize(source)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(target)) as workdir:
+        stage = source
+        if options["downsample_dpi"]:
+            stage = os.path.join(workdir, "downsampled.pdf")
+            ghostscript_downsample(source, stage, options["downsample_dpi"])
+
+        candidate = os.path.join(workdir, "optimized.pdf")
+        with pikepdf.open(stage) as pdf:
+            pdf.remove_unreferenced_resources()
+            pdf.save(
+                candidate,
+                compress_streams=True,
+                recompress_flate=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                linearize=options["linearize"],
+                deterministic_id=True,
+            )
+
+        output_size = os.path.getsize(candidate)
+        kept_source = output_size >= source_size
+        if kept_source:
+            # Nothing gained; make sure no older, stale copy is served instead
+            if os.path.exists(target):
+                os.remove(target)
+        else:
+            os.replace(candidate, target)
+
+    return {
+        "source_size": source_size,
+        "output_size": source_size if kept_source else output_size,
+        "kept_source": kept_source,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def load_manifest(output_root):
+    try:
+        with open(os.path.join(output_root, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_manifest(output_root, manifest):
+    path = os.path.join(output_root, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def print_report(rows):
+    print(f"{'file':<60} {'before':>10} {'after':>10} {'saved':>7} {'secs':>7}")
+    for relpath, row in sorted(rows.items()):
+        saved = 1 - row["output_size"] / row["source_size"] if row["source_size"] else 0
+        note = " (skipped)" if row.get("skipped") else " (kept original)" if row["kept_source"] else ""
+        print(f"{relpath:<60} {row['source_size']:>10} {row['output_size']:>10} {saved:>6.1%} {row['seconds']:>7}{note}")
+    before = sum(row["source_size"] for row in rows.values())
+    after = sum(row["output_size"] for row in rows.values())
+    seconds = sum(row["seconds"] for row in rows.values())
+    saved = 1 - after / before if before else 0
+    print(f"{'total':<60} {before:>10} {after:>10} {saved:>6.1%} {round(seconds, 3):>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default=PAPER_FOLDER)
+    parser.add_argument("--output", default=OPTIMIZED_FOLDER)
+    parser.add_argument("--downsample-dpi", type=int, default=0, help="downsample images with gs (0 = off)")
+    parser.add_argument("--linearize", action="store_true", help="fast web view layout")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--force", action="store_true", help="ignore the manifest and redo every file")
+    parser.add_argument("--report", help="also write the per-file report as JSON")
+    args = parser.parse_args()
+
+    try:
+        import pikepdf  # noqa: F401
+    except ImportError:
+        print("❌ pikepdf is required: pip install pikepdf")
+        return 1
+    if args.downsample_dpi and not shutil.which("gs"):
+        print("❌ --downsample-dpi needs Ghostscript (gs) on PATH")
+        return 1
+
+    options = {"downsample_dpi": args.downsample_dpi, "linearize": args.linearize}
+    manifest = {} if args.force else load_manifest(args.output)
+    rows = {}
+    pending = {}
+
+    for relpath in find_pdfs(args.source):
+        source = os.path.join(args.source, relpath)
+        digest = file_sha256(source)
+        previous = manifest.get(relpath)
+        target = os.path.join(args.output, relpath)
+        up_to_date = (
+            previous
+            and previous["source_sha256"] == digest
+            and previous["options"] == options
+            and (previous["kept_source"] or os.path.exists(target))
+        )
+        if up_to_date:
+            rows[relpath] = {**previous, "seconds": 0, "skipped": True}
+        else:
+            pending[relpath] = digest
+
+    failed = 0
+    os.makedirs(args.output, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(optimize_file, os.path.join(args.source, relpath), os.path.join(args.output, relpath), options): relpath
+            for relpath in pending
+        }
+        for future in as_completed(futures):
+            relpath = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                failed += 1
+                manifest.pop(relpath, None)
+                print(f"❌ {relpath}: {e}")
+                continue
+            rows[relpath] = row
+            manifest[relpath] = {"source_sha256": pending[relpath], "options": options, **row}
+            # Saved as we go so an interrupted run keeps its finished files
+            save_manifest(args.output, manifest)
+
+    print_report(rows)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(rows, f, indent=2, sort_keys=True)
+    optimized = len(pending) - failed
+    print(f"✅ {optimized} optimized, {len(rows) - optimized} unchanged, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())